@@ -10,80 +10,99 @@
 
 import httplib, struct, sys
 import md5, md5daap
+import collections
 import gzip
 import logging
+import multiprocessing
+import Queue
+import threading
+import time
+import zlib
 from cStringIO import StringIO
 
-__all__ = ['DAAPError', 'DAAPObject', 'DAAPClient', 'DAAPSession', 'DAAPDatabase', 'DAAPPlaylist', 'DAAPTrack']
+__all__ = ['DAAPError', 'DAAPAuthError', 'DAAPObject', 'DAAPClient', 'DAAPSession', 'DAAPDatabase', 'DAAPPlaylist', 'DAAPTrack']
 
 log = logging.getLogger('daap')
 
 # the itunes authentication hasher
 seed_v2 = []
-for i in (range(255)):
-    ctx = md5.new()
-    if (i & 0x80): ctx.update("Accept-Language")
-    else:          ctx.update("user-agent")
+def _make_seed_v2():
+    # computing all the seeds takes a while, so only do it when
+    # the first request is hashed
+    seeds = []
+    for i in (range(255)):
+        ctx = md5.new()
+        if (i & 0x80): ctx.update("Accept-Language")
+        else:          ctx.update("user-agent")
 
-    if (i & 0x40): ctx.update("max-age")
-    else:          ctx.update("Authorization")
+        if (i & 0x40): ctx.update("max-age")
+        else:          ctx.update("Authorization")
 
-    if (i & 0x20): ctx.update("Client-DAAP-Version")
-    else:          ctx.update("Accept-Encoding")
+        if (i & 0x20): ctx.update("Client-DAAP-Version")
+        else:          ctx.update("Accept-Encoding")
 
-    if (i & 0x10): ctx.update("daap.protocolversion")
-    else:          ctx.update("daap.songartist")
+        if (i & 0x10): ctx.update("daap.protocolversion")
+        else:          ctx.update("daap.songartist")
 
-    if (i & 0x08): ctx.update("daap.songcomposer")
-    else:          ctx.update("daap.songdatemodified")
+        if (i & 0x08): ctx.update("daap.songcomposer")
+        else:          ctx.update("daap.songdatemodified")
 
-    if (i & 0x04): ctx.update("daap.songdiscnumber")
-    else:          ctx.update("daap.songdisabled")
+        if (i & 0x04): ctx.update("daap.songdiscnumber")
+        else:          ctx.update("daap.songdisabled")
 
-    if (i & 0x02): ctx.update("playlist-item-spec")
-    else:          ctx.update("revision-number")
+        if (i & 0x02): ctx.update("playlist-item-spec")
+        else:          ctx.update("revision-number")
 
-    if (i & 0x01): ctx.update("session-id")
-    else:          ctx.update("content-codes")
+        if (i & 0x01): ctx.update("session-id")
+        else:          ctx.update("content-codes")
 
-    seed_v2.append( ctx.hexdigest().upper() )
+        seeds.append( ctx.hexdigest().upper() )
+    # all at once, in case several threads get here at the same time
+    seed_v2[:] = seeds
 
 # this is a translation of the GenerateHash function in hasher.c of
 # libopendaap http://crazney.net/programs/itunes/authentication.html
 seed_v3 = []
-for i in (range(255)):
-    ctx = md5daap.new()
+def _make_seed_v3():
+    # computing all the seeds takes a while, so only do it when
+    # the first request is hashed
+    seeds = []
+    for i in (range(255)):
+        ctx = md5daap.new()
 
-    if (i & 0x40): ctx.update("eqwsdxcqwesdc")
-    else:          ctx.update("op[;lm,piojkmn")
+        if (i & 0x40): ctx.update("eqwsdxcqwesdc")
+        else:          ctx.update("op[;lm,piojkmn")
 
-    if (i & 0x20): ctx.update("876trfvb 34rtgbvc")
-    else:          ctx.update("=-0ol.,m3ewrdfv")
+        if (i & 0x20): ctx.update("876trfvb 34rtgbvc")
+        else:          ctx.update("=-0ol.,m3ewrdfv")
 
-    if (i & 0x10): ctx.update("87654323e4rgbv ")
-    else:          ctx.update("1535753690868867974342659792")
+        if (i & 0x10): ctx.update("87654323e4rgbv ")
+        else:          ctx.update("1535753690868867974342659792")
 
-    if (i & 0x08): ctx.update("Song Name")
-    else:          ctx.update("DAAP-CLIENT-ID:")
+        if (i & 0x08): ctx.update("Song Name")
+        else:          ctx.update("DAAP-CLIENT-ID:")
 
-    if (i & 0x04): ctx.update("111222333444555")
-    else:          ctx.update("4089961010")
+        if (i & 0x04): ctx.update("111222333444555")
+        else:          ctx.update("4089961010")
 
-    if (i & 0x02): ctx.update("playlist-item-spec")
-    else:          ctx.update("revision-number")
+        if (i & 0x02): ctx.update("playlist-item-spec")
+        else:          ctx.update("revision-number")
 
-    if (i & 0x01): ctx.update("session-id")
-    else:          ctx.update("content-codes")
+        if (i & 0x01): ctx.update("session-id")
+        else:          ctx.update("content-codes")
 
-    if (i & 0x80): ctx.update("IUYHGFDCXWEDFGHN")
-    else:          ctx.update("iuytgfdxwerfghjm")
+        if (i & 0x80): ctx.update("IUYHGFDCXWEDFGHN")
+        else:          ctx.update("iuytgfdxwerfghjm")
 
-    seed_v3.append( ctx.hexdigest().upper() )
+        seeds.append( ctx.hexdigest().upper() )
+    # all at once, in case several threads get here at the same time
+    seed_v3[:] = seeds
 
 def hash_v2(url, select):
     ctx = md5.new()
     ctx.update( url )
     ctx.update( "Copyright 2003 Apple Computer, Inc." )
+    if not seed_v2: _make_seed_v2()
     ctx.update( seed_v2[ select ])
     return ctx.hexdigest().upper()
 
@@ -91,6 +110,7 @@ def hash_v3(url, select, sequence = 0):
     ctx = md5daap.new()
     ctx.update( url )
     ctx.update( "Copyright 2003 Apple Computer, Inc." )
+    if not seed_v3: _make_seed_v3()
     ctx.update( seed_v3[ select ])
     if sequence > 0: ctx.update( str(sequence) )
     return ctx.hexdigest().upper()
@@ -179,6 +199,10 @@ def DAAPParseCodeTypes(treeroot):
 
 class DAAPError(Exception): pass
 
+class DAAPAuthError(DAAPError):
+    """The server refused a request, because of a wrong password or an
+    expired session."""
+
 class DAAPObject(object):
 
     def getAtom(self, code):
@@ -356,16 +380,34 @@ class DAAPClient(object):
         self.socket = None
         self.request_id = 0
         self._old_itunes = 0
+        # each thread gets its own HTTP connection, see _socket
+        self._local = threading.local()
 
-    def connect(self, hostname, port = 3689, password = None):
+    def connect(self, hostname, port = 3689, password = None, state = None):
+        """Connect to the server. If state is what getState returned for
+        an earlier connection to the same server, the content codes and
+        server info aren't requested again."""
         if self.socket != None:
             raise DAAPError("DAAPClient: already connected.")
         self.hostname = hostname
         self.port     = port
         self.password = password
         self.socket = httplib.HTTPConnection(hostname, port)
-        self.getContentCodes() # practically required
-        self.getInfo() # to determine the remote server version
+        self._local.socket = self.socket
+        if state:
+            dmapCodeTypes.update(state['codes'])
+            self._old_itunes = state['old_itunes']
+            self.request_id = state['request_id']
+        else:
+            self.getContentCodes() # practically required
+            self.getInfo() # to determine the remote server version
+
+    def getState(self):
+        """Returns what connect needs to skip the setup requests next
+        time. It can be pickled."""
+        return {'codes': dict(dmapCodeTypes),
+                'old_itunes': self._old_itunes,
+                'request_id': self.request_id}
 
     def _get_response(self, r, params = {}, gzip = 1):
         """Makes a request, doing the right thing, returns the raw data"""
@@ -403,15 +445,25 @@ class DAAPClient(object):
 	# there are servers that don't allow >1 download from a single HTTP
 	# session, or something. Reset the connection each time. Thanks to
 	# Fernando Herrera for this one.
-        self.socket.close()
-        self.socket.connect()
+        socket = self._socket()
+        socket.close()
+        socket.connect()
 
         #print r
-        self.socket.request('GET', r, None, headers)
+        socket.request('GET', r, None, headers)
 
-        response    = self.socket.getresponse()
+        response    = socket.getresponse()
         return response;
 
+    def _socket(self):
+        """Returns the HTTP connection of the calling thread, so that
+        several threads can make requests at once."""
+        socket = getattr(self._local, 'socket', None)
+        if socket == None:
+            socket = httplib.HTTPConnection(self.hostname, self.port)
+            self._local.socket = socket
+        return socket
+
     def request(self, r, params = {}, answers = 1):
         """Make a request to the DAAP server, with the passed params. This
         deals with all the cikiness like validation hashes, etc, etc"""
@@ -431,19 +483,103 @@ class DAAPClient(object):
         # close this, we're done with it
         response.close()
 
+        if not self._checkStatus(r, status):
+            # no content, ie logout messages
+            return None
+
+        return self.readResponse( content )
+
+    def _checkStatus(self, r, status):
+        """Raise a DAAPError for failed requests. Returns False if there
+        is no content to read."""
         if status == 401:
-            raise DAAPError('DAAPClient: %s: auth required'%r)
+            raise DAAPAuthError('DAAPClient: %s: auth required'%r)
         elif status == 403:
-            raise DAAPError('DAAPClient: %s: Authentication failure'%r)
+            raise DAAPAuthError('DAAPClient: %s: Authentication failure'%r)
         elif status == 503:
             raise DAAPError('DAAPClient: %s: 503 - probably max connections to server'%r)
         elif status == 204:
-            # no content, ie logout messages
-            return None
+            return False
         elif status != 200:
-            raise DAAPError('DAAPClient: %s: Error %s making request'%(r, response.status))
-
-        return self.readResponse( content )
+            raise DAAPError('DAAPClient: %s: Error %s making request'%(r, status))
+        return True
+
+    def requestItems(self, r, params = {}, container = 'mlcl'):
+        """Like request, but yields the children of the first 'container'
+        atom in the response one by one, as they are read from the
+        server, instead of waiting for the whole response."""
+        for data in self._requestItemData(r, params, container):
+            object = DAAPObject()
+            object.processData(StringIO(data))
+            yield object
+
+    def requestItemRecords(self, r, params = {}, processes = 1,
+                           chunksize = 1000, container = 'mlcl'):
+        """Like requestItems, but yields lists of up to chunksize records
+        of the atoms a DAAPTrack looks at, in order. They are decoded by
+        a decoder specialized for the atoms listed in the 'meta'
+        parameter. Unless processes is 1, the records are decoded in the
+        worker processes started by startPool while the response is still
+        being read; without them, they are decoded here."""
+        meta = params.get('meta', '')
+        chunks = self._requestItemChunks(r, params, container, chunksize)
+        if processes == 1 or _pool == None:
+            for chunk in chunks:
+                yield map(_ItemRecord, _decodeItems(chunk, meta))
+            return
+        # the workers were started before the content codes were known
+        codes = dict([(c, dmapCodeTypes[c]) for c in _item_codes
+                      if dmapCodeTypes.has_key(c)])
+        # Keep a few chunks queued up for each worker so that none of
+        # them sits idle.
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(_pool.apply_async(_decodeItemsWith,
+                                             (chunk, meta, codes)))
+            if len(pending) > 2 * _pool_size:
+                yield map(_ItemRecord, pending.popleft().get())
+        while pending:
+            yield map(_ItemRecord, pending.popleft().get())
+
+    def _requestItemChunks(self, r, params, container, chunksize):
+        """Yields strings of up to chunksize consecutive encoded children
+        of the first 'container' atom in the response."""
+        chunk = []
+        for data in self._requestItemData(r, params, container):
+            chunk.append(data)
+            if len(chunk) >= chunksize:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+    def _requestItemData(self, r, params, container):
+        """Yields the encoded children of the first 'container' atom in
+        the response, using only their lengths to find them."""
+        response = self._get_response(r, params)
+        try:
+            if not self._checkStatus(r, response.status):
+                return
+            stream = _ResponseStream(response)
+            while True:
+                header = stream.read(8)
+                if len(header) < 8:
+                    return
+                code, length = struct.unpack('!4sI', header)
+                if code == container:
+                    end = stream.tell() + length
+                    while stream.tell() < end:
+                        header = stream.read(8)
+                        length = struct.unpack('!4sI', header)[1]
+                        yield header + stream.read(length)
+                    return
+                elif not dmapCodeTypes.has_key(code) or dmapCodeTypes[code][1] != 'c':
+                    # skip over it, we're only interested in containers
+                    stream.read(length)
+                # else it's a container, so just carry on reading its
+                # contents.
+        finally:
+            response.close()
 
     def readResponse(self, data):
         """Convert binary response from a request to a DAAPObject"""
@@ -478,28 +614,186 @@ class DAAPClient(object):
         log.debug("Logged in as session %s", sessionid)
         return DAAPSession(self, sessionid)
 
+    def resume(self, sessionid):
+        """Returns a DAAPSession for the session id of an earlier login,
+        without asking the server. If it has expired the session, it is
+        logged in again on its first request."""
+        log.debug("Resuming session %s", sessionid)
+        return DAAPSession(self, sessionid)
+
+
+class _ResponseStream(object):
+    """Minimal file-like object reading a (possibly gzipped) HTTP response
+    as it arrives."""
+
+    def __init__(self, response, blocksize = 64 * 1024):
+        self.response = response
+        self.blocksize = blocksize
+        self.decompressor = None
+        if response.getheader("Content-Encoding") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.offset = 0
+        self.pos = 0
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n):
+        while len(self.buffer) - self.offset < n:
+            data = self.response.read(self.blocksize)
+            if self.decompressor:
+                if data:
+                    data = self.decompressor.decompress(data)
+                else:
+                    data = self.decompressor.flush()
+                    self.decompressor = None
+            elif not data:
+                break
+            self.buffer = self.buffer[self.offset:] + data
+            self.offset = 0
+        data = self.buffer[self.offset:self.offset + n]
+        self.offset += len(data)
+        self.pos += len(data)
+        return data
+
 
 class DAAPSession(object):
 
+    # seconds memoized responses are used for before the revision is
+    # checked again
+    update_interval = 10
+
     def __init__(self, connection, sessionid):
         self.connection = connection
         self.sessionid  = sessionid
         self.revision   = 1
+        # memoized responses, key -> (revision, value), see _memoize
+        self._memo = {}
+        # when the revision was last checked
+        self._updated = 0
+        self._memo_lock = threading.Lock()
+        # held while logging in again, see relogin
+        self._login_lock = threading.Lock()
 
     def request(self, r, params = {}, answers = 1):
         """Pass the request through to the connection, adding the session-id
-        parameter."""
-        params['session-id'] = self.sessionid
-        return self.connection.request(r, params, answers)
+        parameter. If the session has expired, log in again and retry."""
+        sessionid = params['session-id'] = self.sessionid
+        try:
+            return self.connection.request(r, params, answers)
+        except DAAPAuthError:
+            self.relogin(sessionid)
+            params['session-id'] = self.sessionid
+            return self.connection.request(r, params, answers)
+
+    def requestItems(self, r, params = {}, container = 'mlcl'):
+        """Pass the request through to the connection's requestItems,
+        adding the session-id parameter."""
+        return self._retryItems(self.connection.requestItems, r, params,
+                                container)
+
+    def requestItemRecords(self, r, params = {}, processes = 1,
+                           chunksize = 1000, container = 'mlcl'):
+        """Pass the request through to the connection's
+        requestItemRecords, adding the session-id parameter."""
+        return self._retryItems(self.connection.requestItemRecords, r,
+                                params, processes, chunksize, container)
+
+    def _retryItems(self, method, r, params, *args):
+        """Yields the items of method(r, params, *args), logging in
+        again and starting over if the session has expired. That's
+        found out before the first item is read, so none are repeated."""
+        sessionid = params['session-id'] = self.sessionid
+        items = method(r, params, *args)
+        try:
+            first = items.next()
+        except StopIteration:
+            return
+        except DAAPAuthError:
+            self.relogin(sessionid)
+            params['session-id'] = self.sessionid
+            items = method(r, params, *args)
+            first = items.next()
+        yield first
+        for item in items:
+            yield item
+
+    def relogin(self, expired = None):
+        """Log in again after the server expired this session. The
+        connection's request_id is left alone, so the retried request
+        is hashed with the same id as the one that failed. Several
+        threads can find out about the expiry at once: if expired, the
+        session id that was turned down, has already been replaced by
+        another thread, its new session is used instead."""
+        self._login_lock.acquire()
+        try:
+            if expired != None and expired != self.sessionid:
+                return
+            session = self.connection.login()
+            if session == None:
+                raise DAAPError('DAAPSession: could not log in again')
+            log.debug('DAAPSession: session %s replaces expired session %s',
+                      session.sessionid, self.sessionid)
+            self.sessionid = session.sessionid
+        finally:
+            self._login_lock.release()
 
     def update(self):
+        """Asks the server for its revision. If it has changed, anything
+        memoized is dropped and fetched again when it's next needed."""
         response = self.request("/update")
         #response.printTree()
+        self._updated = time.time()
+        revision = response.getAtom("musr")
+        if revision and revision != self.revision:
+            log.debug('DAAPSession: revision %s -> %s', self.revision,
+                      revision)
+            self._memo_lock.acquire()
+            try:
+                self.revision = revision
+                self._memo.clear()
+            finally:
+                self._memo_lock.release()
+
+    def _memoize(self, key, fetch):
+        """Returns fetch(), reusing its earlier value for the same key
+        while the revision hasn't changed. The revision is checked
+        again if that was more than update_interval seconds ago."""
+        if time.time() - self._updated >= self.update_interval:
+            self.update()
+        self._memo_lock.acquire()
+        try:
+            entry = self._memo.get(key)
+        finally:
+            self._memo_lock.release()
+        if entry != None and entry[0] == self.revision:
+            return entry[1]
+        revision = self.revision
+        value = fetch()
+        self._memo_lock.acquire()
+        try:
+            self._memo[key] = (revision, value)
+        finally:
+            self._memo_lock.release()
+        return value
+
+    def prefetch(self, threads = 4):
+        """Fetches the database list, the playlists of every database and
+        the item ids of every playlist, using several connections at
+        once, and memoizes them so that browsing is instant."""
+        self.update()
+        databases = self.databases()
+        _concurrently([d.playlists for d in databases], threads)
+        _concurrently([p.itemIds for d in databases for p in d.playlists()],
+                      threads)
 
     def databases(self):
-        response = self.request("/databases")
-        db_list = response.getAtom("mlcl").contains
-        return [DAAPDatabase(self, d) for d in db_list]
+        def fetch():
+            response = self.request("/databases")
+            db_list = response.getAtom("mlcl").contains
+            return [DAAPDatabase(self, d) for d in db_list]
+        return self._memoize('databases', fetch)
 
     def library(self):
         # there's only ever one db, and it's always the library...
@@ -513,7 +807,7 @@ class DAAPSession(object):
 # the atoms we want. Making this list smaller reduces memory footprint,
 # and speeds up reading large libraries. It also reduces the metainformation
 # available to the client.
-daap_atoms = "dmap.itemid,dmap.itemname,daap.songalbum,daap.songartist,daap.songformat,daap.songtime,daap.songsize,daap.songgenre,daap.songyear,daap.songtracknumber"
+daap_atoms = "dmap.itemid,dmap.itemname,daap.songalbum,daap.songartist,daap.songformat,daap.songtime,daap.songsize,daap.songgenre,daap.songyear,daap.songtracknumber,daap.songbitrate,daap.songdiscnumber"
 
 class DAAPDatabase(object):
 
@@ -521,20 +815,27 @@ class DAAPDatabase(object):
         self.session = session
         self.name = atom.getAtom("minm")
         self.id = atom.getAtom("miid")
+        self.count = atom.getAtom("mimc")
 
     def tracks(self):
         """returns all the tracks in this database, as DAAPTrack objects"""
-        response = self.session.request("/databases/%s/items"%self.id, {
-            'meta':daap_atoms
-        })
-        #response.printTree()
-        track_list = response.getAtom("mlcl").contains
-        return [DAAPTrack(self, t) for t in track_list]
+        return [t for batch in self.iterTracks() for t in batch]
+
+    def iterTracks(self, batchsize = 1000, processes = 1):
+        """yields lists of up to batchsize DAAPTrack objects as they are
+        read from the server. Unless processes is 1, they are decoded by
+        the worker processes started by startPool, if there are any."""
+        for records in self.session.requestItemRecords(
+            "/databases/%s/items"%self.id, {'meta':daap_atoms},
+            processes, batchsize):
+            yield [DAAPTrack(self, t) for t in records]
 
     def playlists(self):
-        response = self.session.request("/databases/%s/containers"%self.id)
-        db_list = response.getAtom("mlcl").contains
-        return [DAAPPlaylist(self, d) for d in db_list]
+        def fetch():
+            response = self.session.request("/databases/%s/containers"%self.id)
+            db_list = response.getAtom("mlcl").contains
+            return [DAAPPlaylist(self, d) for d in db_list]
+        return self.session._memoize(('playlists', self.id), fetch)
 
 
 class DAAPPlaylist(object):
@@ -547,11 +848,24 @@ class DAAPPlaylist(object):
 
     def tracks(self):
         """returns all the tracks in this playlist, as DAAPTrack objects"""
-        response = self.database.session.request("/databases/%s/containers/%s/items"%(self.database.id,self.id), {
+        tracks = []
+        for records in self.database.session.requestItemRecords("/databases/%s/containers/%s/items"%(self.database.id,self.id), {
             'meta':daap_atoms
-        })
-        track_list = response.getAtom("mlcl").contains
-        return [DAAPTrack(self.database, t) for t in track_list]
+        }):
+            tracks.extend([DAAPTrack(self.database, t) for t in records])
+        return tracks
+
+    def itemIds(self):
+        """returns the ids of the tracks in this playlist, in order"""
+        def fetch():
+            ids = []
+            for records in self.database.session.requestItemRecords("/databases/%s/containers/%s/items"%(self.database.id,self.id), {
+                'meta':'dmap.itemid'
+            }):
+                ids.extend([r.getAtom('miid') for r in records])
+            return ids
+        return self.database.session._memoize(
+            ('items', self.database.id, self.id), fetch)
 
 
 class DAAPTrack(object):
@@ -587,13 +901,22 @@ class DAAPTrack(object):
         return str(self.__unicode__().encode('utf-8', 'replace'))
 
     def __init__(self, database, atom):
+        """atom is the item as read from the server, usually an
+        _ItemRecord with just the atoms in attrmap rather than the
+        whole DAAPObject tree."""
         self.database = database
         self.atom = atom
-        self.uri = ("http://%s:%d/databases/%s/items/%s.%s?session-id:%d"
-                    % (self.database.session.connection.hostname,
-                       self.database.session.connection.port,
-                       self.database.id, self.id, self.type,
-                       self.database.session.sessionid))
+
+    def _getUri(self):
+        # built on every access, so it has the current session id even
+        # after the session has been logged in again
+        return ("http://%s:%d/databases/%s/items/%s.%s?session-id:%d"
+                % (self.database.session.connection.hostname,
+                   self.database.session.connection.port,
+                   self.database.id, self.id, self.type,
+                   self.database.session.sessionid))
+
+    uri = property(_getUri)
 
     def __getattr__(self, name):
         if self.__dict__.has_key(name):
@@ -632,6 +955,160 @@ class DAAPTrack(object):
         log.debug("Done")
 
 
+def _concurrently(calls, threads):
+    """Calls each of the given functions, with up to threads of them
+    running at once. Raises the first exception any of them raised."""
+    queue = Queue.Queue()
+    for call in calls:
+        queue.put(call)
+    errors = []
+    def work():
+        while True:
+            try:
+                call = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                call()
+            except Exception, e:
+                errors.append(e)
+    workers = [threading.Thread(target=work)
+               for i in range(min(threads, len(calls)))]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0]
+
+# the atoms kept for each decoded item, the ones DAAPTrack looks at
+_item_codes = sorted(set(DAAPTrack.attrmap.values()))
+_item_index = dict([(c, i) for i, c in enumerate(_item_codes)])
+
+class _ItemRecord(tuple):
+    """The values of _item_codes for one decoded item. It stands in for
+    the item's DAAPObject tree as DAAPTrack.atom, with the same getAtom
+    and printTree, but only has the atoms in _item_codes."""
+
+    def getAtom(self, code):
+        # like DAAPObject.getAtom, empty values are None
+        if _item_index.has_key(code):
+            return self[_item_index[code]] or None
+        return None
+
+    def printTree(self, level = 0, out = sys.stdout):
+        out.write('\t' * level + 'dmap.listingitem (mlit)\tc\tNone\n')
+        for code, value in zip(_item_codes, self):
+            if value == None:
+                continue
+            name, type = dmapCodeTypes.get(code, (None, None))
+            out.write('\t' * (level + 1) + '%s (%s)\t%s\t%s\n'
+                      % (name, code, type, value))
+
+_header = struct.Struct('!4sI').unpack_from
+
+_structTypes = {
+    'b':'!b', 'ub':'!B', 'h':'!h', 'uh':'!H', 'i':'!i', 'ui':'!I',
+    'l':'!q', 'ul':'!Q', 't':'!I',
+}
+
+def _decodeAtom(data, pos, length):
+    """Decodes the value of the atom at pos the slow way, with
+    DAAPObject.processData."""
+    object = DAAPObject()
+    object.processData(StringIO(data[pos - 8:pos + length]))
+    return getattr(object, 'value', None)
+
+# decoders made by _itemDecoder, by meta list and content code types
+_itemDecoders = {}
+
+def _itemDecoder(meta):
+    """Returns a function decoding the atoms of one item in a string
+    into a list of the values of _item_codes. It is specialized for
+    the atoms named in meta (as in daap_atoms) and the content code
+    table the server sent, so expected atoms go straight to their slot
+    and unpacker, anything else in _item_codes is decoded the slow way,
+    and all other atoms are skipped."""
+    key = (meta, tuple([dmapCodeTypes.get(c) for c in _item_codes]))
+    if _itemDecoders.has_key(key):
+        return _itemDecoders[key]
+    names = meta.split(',')
+    # code: (slot, dtype, unpack_from, size), with a dtype of None for
+    # atoms that have to be decoded the slow way
+    fields = {}
+    for i, code in enumerate(_item_codes):
+        name, dtype = dmapCodeTypes.get(code, (None, None))
+        if name not in names or (dtype != 's' and
+                                 not _structTypes.has_key(dtype)):
+            fields[code] = (i, None, None, None)
+        elif dtype == 's':
+            fields[code] = (i, dtype, None, None)
+        else:
+            packing = struct.Struct(_structTypes[dtype])
+            fields[code] = (i, dtype, packing.unpack_from, packing.size)
+    count = len(_item_codes)
+    def decode(data, pos, end):
+        values = [None] * count
+        while pos < end:
+            code, length = _header(data, pos)
+            pos += 8
+            if code in fields:
+                i, dtype, unpack_from, size = fields[code]
+                if dtype == 's':
+                    value = data[pos:pos + length]
+                    try:
+                        values[i] = unicode(value, 'utf-8')
+                    except UnicodeDecodeError:
+                        # oh, urgh
+                        values[i] = unicode(value, 'latin-1')
+                elif length == size:
+                    values[i] = unpack_from(data, pos)[0]
+                else:
+                    values[i] = _decodeAtom(data, pos, length)
+            pos += length
+        return values
+    _itemDecoders[key] = decode
+    return decode
+
+# the worker processes of requestItemRecords, see startPool
+_pool = None
+_pool_size = 0
+
+def startPool(processes = None):
+    """Starts processes worker processes (None for one per CPU) for
+    requestItemRecords to decode items in, unless they are already
+    running. A process forked while other threads hold locks
+    (logging's, GStreamer's) can deadlock on them, so the earlier it is
+    called the safer. Returns the number of workers."""
+    global _pool, _pool_size
+    if _pool == None:
+        if processes == None:
+            processes = multiprocessing.cpu_count()
+        _pool = multiprocessing.Pool(processes)
+        _pool_size = processes
+    return _pool_size
+
+def _decodeItemsWith(data, meta, codes):
+    """_decodeItems in a worker process, with the content code types
+    of the atoms in _item_codes."""
+    dmapCodeTypes.update(codes)
+    return _decodeItems(data, meta)
+
+def _decodeItems(data, meta):
+    """Decodes a string of consecutive items into tuples of the values
+    of _item_codes. Runs in the worker processes of requestItemRecords,
+    so it returns plain tuples, which are quicker to send back."""
+    decode = _itemDecoder(meta)
+    records = []
+    pos = 0
+    while pos < len(data):
+        length = _header(data, pos)[1]
+        pos += 8
+        records.append(tuple(decode(data, pos, pos + length)))
+        pos += length
+    return records
+
 if __name__ == '__main__':
     def main():
         connection  = DAAPClient()
@@ -30,36 +30,370 @@ This is known to work with Firefly media server (mt-daapd), but
 probably won't work with iTunes.
 
 Run it from the python shell or use the included shell interface.
+With -d, the shell keeps running in the background and -c sends it
+commands, e.g. "daap_player.py -c next" from a key binding.
 """
 
 __author__ = "Ron Weiss (ronw@ee.columbia.edu)"
 
+import array
+import BaseHTTPServer
+import bisect
 import cmd
+import collections
+import cProfile
+import gc
 import glob
 import inspect
+import itertools
+import mmap
+import multiprocessing
 import operator
+import optparse
 import os
 import pickle
+import pstats
 import pydoc
+import Queue
 import random
 import re
 import readline
+import resource
+import select
+import socket
+import SocketServer
+import sqlite3
+import struct
+import subprocess
 import sys
-import thread
+import threading
 import time
 import types
 import urllib
+import urllib2
+import urlparse
+try:
+    import tracemalloc
+except ImportError:
+    # Only available in Python 2 through the pytracemalloc backport.
+    tracemalloc = None
 
-import tagpy
+import daap
 
-# for gstreamer
-import gobject 
-gobject.threads_init()
-import pygst
-pygst.require("0.10")
-import gst
+# tagpy is only needed to scan directories and gstreamer only once
+# something is played.  Both are slow to import, so they are imported
+# on first use by _import_tagpy and _import_gst.
+tagpy = None
+gobject = None
+gst = None
+# Only needed for the stats command, see _import_numpy.
+numpy = None
 
-import daap
+
+def _import_tagpy():
+    global tagpy
+    if tagpy is None:
+        import tagpy
+    return tagpy
+
+
+def _import_gst():
+    global gobject, gst
+    if gst is None:
+        import gobject
+        gobject.threads_init()
+        import pygst
+        pygst.require("0.10")
+        import gst
+    return gst
+
+
+def _import_numpy():
+    global numpy
+    if numpy is None:
+        import numpy
+    return numpy
+
+
+def _metrics_server(uri):
+    """ Return the server a track is played from, for labelling
+    metrics: host:port for streamed tracks, 'local' for files. """
+    if not uri:
+        return 'unknown'
+    return urlparse.urlsplit(uri).netloc or 'local'
+
+
+class _Histogram(object):
+    """ Counts of observations at or below each bucket bound, in the
+    way Prometheus histograms are exported. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """ Return (bound, count) pairs, ending with +Inf. """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to the shell.
+        pass
+
+
+class PlaybackMetrics(object):
+    """
+    What playback was like, per server the tracks came from: how long
+    tracks took to start, the gaps between tracks, buffering stalls,
+    network read rates and errors.
+
+    A track has started when its pipeline has prerolled and is playing
+    (ASYNC_DONE), which is as close as playbin gets to first audio.
+    The metrics can be exported in the Prometheus text format, see
+    prometheus, write and serve.
+    """
+    # Seconds
+    latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stalled = {}
+        self.__writer = None
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        """ Forget everything recorded so far. """
+        with self.__lock:
+            self.started = time.time()
+            # server -> _Histogram
+            self.track_starts = {}
+            self.gaps = {}
+            self.stall_times = {}
+            # server -> count
+            self.gapless = collections.defaultdict(int)
+            self.stalls = collections.defaultdict(int)
+            self.errors = collections.defaultdict(int)
+            self.read_bytes = collections.defaultdict(int)
+            self.read_seconds = collections.defaultdict(float)
+            # server -> bytes per second, as last measured by GStreamer
+            self.stream_rates = {}
+
+    def __observe(self, histograms, uri, value):
+        server = _metrics_server(uri)
+        with self.__lock:
+            if server not in histograms:
+                histograms[server] = _Histogram(self.latency_buckets)
+            histograms[server].observe(value)
+
+    def track_started(self, uri, seconds):
+        """ Record that a track took seconds from play() to playing. """
+        self.__observe(self.track_starts, uri, seconds)
+
+    def track_gap(self, uri, seconds):
+        """ Record a gap of seconds between the end of one track and
+        the next one playing; 0 for a gapless switch. """
+        if not seconds:
+            with self.__lock:
+                self.gapless[_metrics_server(uri)] += 1
+        self.__observe(self.gaps, uri, seconds)
+
+    def stall_started(self, uri):
+        """ Record that playback stopped to wait for the network. """
+        server = _metrics_server(uri)
+        with self.__lock:
+            if server not in self.__stalled:
+                self.__stalled[server] = time.time()
+                self.stalls[server] += 1
+
+    def stall_ended(self, uri):
+        server = _metrics_server(uri)
+        with self.__lock:
+            started = self.__stalled.pop(server, None)
+        if started is not None:
+            self.__observe(self.stall_times, uri, time.time() - started)
+
+    def read(self, uri, nbytes, seconds):
+        """ Record that nbytes took seconds to download. """
+        server = _metrics_server(uri)
+        with self.__lock:
+            self.read_bytes[server] += nbytes
+            self.read_seconds[server] += seconds
+
+    def stream_rate(self, uri, rate):
+        """ Record the rate (bytes per second) a track is being streamed
+        at. """
+        with self.__lock:
+            self.stream_rates[_metrics_server(uri)] = rate
+
+    def error(self, uri):
+        with self.__lock:
+            self.errors[_metrics_server(uri)] += 1
+
+    def servers(self):
+        with self.__lock:
+            servers = set(self.track_starts)
+            for x in (self.gaps, self.stall_times, self.stalls, self.errors,
+                      self.read_bytes, self.stream_rates):
+                servers.update(x)
+        return sorted(servers)
+
+    def __str__(self):
+        servers = self.servers()
+        if not servers:
+            return 'Nothing played since %s.' % time.ctime(self.started)
+        def latency(histogram):
+            if histogram is None or not histogram.count:
+                return '-'
+            return 'mean %0.0f ms, max %0.0f ms over %d' % (
+                1e3 * histogram.sum / histogram.count, 1e3 * histogram.max,
+                histogram.count)
+        lines = ['Since %s:' % time.ctime(self.started)]
+        with self.__lock:
+            for server in servers:
+                rate = '-'
+                if self.read_seconds.get(server):
+                    rate = '%0.0f KB/s downloaded' % (
+                        self.read_bytes[server] / 1024.0
+                        / self.read_seconds[server])
+                if server in self.stream_rates:
+                    rate = '%0.0f KB/s streamed, %s' % (
+                        self.stream_rates[server] / 1024.0, rate)
+                lines.extend([
+                    server,
+                    '  track start: %s' % latency(
+                        self.track_starts.get(server)),
+                    '  track gaps:  %s, %d gapless' % (
+                        latency(self.gaps.get(server)),
+                        self.gapless.get(server, 0)),
+                    '  stalls:      %d, %s' % (
+                        self.stalls.get(server, 0),
+                        latency(self.stall_times.get(server))),
+                    '  read rate:   %s' % rate,
+                    '  errors:      %d' % self.errors.get(server, 0)])
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """ Return the metrics in the Prometheus text exposition
+        format. """
+        lines = []
+        def family(name, type_, help):
+            lines.append('# HELP daap_player_%s %s' % (name, help))
+            lines.append('# TYPE daap_player_%s %s' % (name, type_))
+        def sample(name, server, value, le=None):
+            labels = 'server="%s"' % server.replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+            if le is not None:
+                labels += ',le="%s"' % ('+Inf' if le == float('inf')
+                                        else repr(le))
+            lines.append('daap_player_%s{%s} %s' % (name, labels,
+                                                     repr(float(value))))
+        def histograms(name, histograms, help):
+            family(name, 'histogram', help)
+            for server, histogram in sorted(histograms.items()):
+                for le, count in histogram.cumulative():
+                    sample(name + '_bucket', server, count, le)
+                sample(name + '_sum', server, histogram.sum)
+                sample(name + '_count', server, histogram.count)
+        def values(name, type_, values, help):
+            family(name, type_, help)
+            for server, value in sorted(values.items()):
+                sample(name, server, value)
+
+        with self.__lock:
+            family('start_time_seconds', 'gauge',
+                   'When the metrics were last reset.')
+            lines.append('daap_player_start_time_seconds %r' % self.started)
+            histograms('track_start_seconds', self.track_starts,
+                       'Time from play to the track playing.')
+            histograms('track_gap_seconds', self.gaps,
+                       'Time from the end of a track to the next one '
+                       'playing.')
+            values('gapless_switches_total', 'counter', self.gapless,
+                     'Track changes without a gap.')
+            values('stalls_total', 'counter', self.stalls,
+                     'Times playback stopped to buffer.')
+            histograms('stall_seconds', self.stall_times,
+                       'How long playback stopped to buffer.')
+            values('read_bytes_total', 'counter', self.read_bytes,
+                     'Bytes of tracks downloaded.')
+            values('read_seconds_total', 'counter', self.read_seconds,
+                     'Time spent downloading tracks.')
+            values('stream_rate_bytes_per_second', 'gauge',
+                     self.stream_rates,
+                     'Rate the current track is streamed at.')
+            values('errors_total', 'counter', self.errors,
+                     'Playback and download errors.')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, interval=None):
+        """ Write the metrics to filename, e.g. for node_exporter's
+        textfile collector.  With an interval (in seconds), keep
+        rewriting it in the background; None stops that. """
+        filename = os.path.expanduser(filename)
+        self.__write(filename)
+        if self.__writer is not None:
+            self.__writer.set()
+            self.__writer = None
+        if interval:
+            stop = self.__writer = threading.Event()
+            def rewrite():
+                while not stop.wait(interval):
+                    try:
+                        self.__write(filename)
+                    except EnvironmentError, e:
+                        print "Error writing metrics:", e
+            writer = threading.Thread(target=rewrite)
+            writer.setDaemon(True)
+            writer.start()
+
+    def __write(self, filename):
+        # Replace the file in one go so it is never read half written.
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmpname, 'w')
+        try:
+            f.write(self.prometheus())
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+
+    def serve(self, port=9466, host='127.0.0.1'):
+        """ Serve the metrics over HTTP for Prometheus to scrape, from a
+        background thread. """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        self.server.metrics = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
 
 
 class Player(object):
@@ -67,35 +401,176 @@ class Player(object):
     Simple audio player based on GStreamer's playbin element.
     """
 
-    def __init__(self):
-        self.__player = gst.element_factory_make("playbin", "player")
-        fakesink = gst.element_factory_make("fakesink", "my-fakesink")
-        self.__player.set_property("video-sink", fakesink)
-        bus = self.__player.get_bus()
-        bus.add_watch(self.__handle_message, "message")
+    def __init__(self, cache=None, seek_indexes=None, metrics=None):
+        # The GStreamer pipeline is only created when it is first
+        # needed, see __playbin.
+        self.__player = None
 
         self.__playlist = Playlist()
         self.__state = "STOPPED"
         self.__current_track = 0
+        # Track queued up by __about_to_finish, which only becomes the
+        # current track once GStreamer actually switches to it.
+        self.__queued_track = None
+        self.cache = cache
+        self.seek_indexes = seek_indexes
+        if metrics is None:
+            metrics = PlaybackMetrics()
+        self.metrics = metrics
+
+        # Time at which we started switching tracks, and how long the
+        # last few switches took until the pipeline was playing again.
+        # Switches at the end of a track also note when it ended.
+        self.__switch_started = None
+        self.__eos_time = None
+        self.__latencies = collections.deque(maxlen=100)
+        self.__gapless_switches = 0
+
+        # Protects the player state, which is changed both by the
+        # caller and by the bus message thread.
+        self.__lock = threading.RLock()
 
-        loop = gobject.MainLoop()
-        context = loop.get_context()
-        thread.start_new_thread(self.__poll_for_messages, (context,))
+    def __playbin(self):
+        """ Return the GStreamer pipeline, creating it if necessary. """
+        with self.__lock:
+            if self.__player is None:
+                _import_gst()
+                # playbin2 lets us queue up the next track before the
+                # current one ends (see __about_to_finish).
+                player = gst.element_factory_make("playbin2", "player")
+                fakesink = gst.element_factory_make("fakesink",
+                                                    "my-fakesink")
+                player.set_property("video-sink", fakesink)
+                player.connect("about-to-finish", self.__about_to_finish)
+                bus = player.get_bus()
+                bus.add_watch(self.__handle_message, "message")
+
+                # Bus messages are dispatched by a main loop running in
+                # its own thread, which sleeps until there is something
+                # to do.
+                self.__loop = gobject.MainLoop()
+                self.__loop_thread = threading.Thread(target=self.__loop.run)
+                self.__loop_thread.setDaemon(True)
+                self.__loop_thread.start()
+                self.__player = player
+            return self.__player
+
+    def quit(self):
+        """ Stop playback and shut down the bus message thread. """
+        with self.__lock:
+            self.__state = "STOPPED"
+            if self.__player is None:
+                return
+            self.__player.set_state(gst.STATE_NULL)
+        self.__loop.quit()
+        self.__loop_thread.join()
+
+    def __track_uri(self, track):
+        if self.cache:
+            return self.cache.uri(track)
+        return track.uri
+
+    def __about_to_finish(self, player):
+        """ Queue up the next track while the current one is still
+        playing so that there is no gap between them.  Called from a
+        GStreamer streaming thread. """
+        # Don't wait for the lock: whoever holds it may be waiting for
+        # this thread to stop.  If we skip the next track here, the EOS
+        # handler takes care of it instead.
+        if not self.__lock.acquire(False):
+            return
+        try:
+            next_track = self.__current_track + 1
+            if (self.__state == "PLAYING" and
+                next_track < len(self.__playlist)):
+                uri = self.__track_uri(self.__playlist[next_track])
+                self.__player.set_property('uri', uri)
+                self.__queued_track = next_track
+        finally:
+            self.__lock.release()
+
+    def __switched(self):
+        """ Make the track queued up by __about_to_finish the current
+        one, now that it is playing.  The buffered rest of the previous
+        track can take many seconds to play after the next one was
+        queued. """
+        with self.__lock:
+            if self.__queued_track is None:
+                return
+            self.__played()
+            self.__current_track = self.__queued_track
+            self.__queued_track = None
+            self.__gapless_switches += 1
+            self.metrics.track_gap(self.__player.get_property('uri'), 0.0)
 
     def __handle_message(self, bus, message, tmp):
         t = message.type
+        if (self.__queued_track is not None and
+            t in (getattr(gst, 'MESSAGE_STREAM_START', None),
+                  gst.MESSAGE_DURATION, gst.MESSAGE_TAG)):
+            # GStreamer 1.0 announces the switch to the next track with
+            # STREAM_START; 0.10 only with the new track's duration and
+            # tags.
+            self.__switched()
         if t == gst.MESSAGE_EOS:
+            # We only get here if there was no next track to queue up
+            # in __about_to_finish.
+            self.__played()
+            self.__switch_started = self.__eos_time = time.time()
             self.next()
+        elif t == gst.MESSAGE_ASYNC_DONE:
+            if self.__switch_started is not None:
+                now = time.time()
+                uri = self.__player.get_property('uri')
+                self.__latencies.append(now - self.__switch_started)
+                if self.__eos_time is not None:
+                    self.metrics.track_gap(uri, now - self.__eos_time)
+                else:
+                    self.metrics.track_started(uri,
+                                               now - self.__switch_started)
+                self.__switch_started = self.__eos_time = None
+        elif t == gst.MESSAGE_BUFFERING:
+            self.__buffering(message)
         elif t == gst.MESSAGE_ERROR:
-            self.__player.set_state(gst.STATE_NULL)
+            with self.__lock:
+                uri = self.__player.get_property('uri')
+                self.metrics.stall_ended(uri)
+                self.metrics.error(uri)
+                self.__player.set_state(gst.STATE_NULL)
+                # The track change that failed isn't timed.
+                self.__switch_started = self.__eos_time = None
+                self.__queued_track = None
             err, debug = message.parse_error()
             print "GStreamer error: %s" % err, debug
         return True
 
-    def __poll_for_messages(self, context):
-        while True:
-            context.iteration(True)
-            time.sleep(0.1)
+    def __played(self):
+        """ Note that the current track has been played through, so
+        that the track cache can fetch it now that it isn't streaming
+        it. """
+        if self.cache:
+            try:
+                self.cache.played(self.__playlist[self.__current_track])
+            except IndexError:
+                pass
+
+    def __buffering(self, message):
+        """ Note stalls while streamed tracks buffer, and the rate
+        they are streamed at. """
+        uri = self.__player.get_property('uri')
+        percent = message.parse_buffering()
+        try:
+            mode, avg_in, avg_out, left = message.parse_buffering_stats()
+        except AttributeError:
+            # Needs GStreamer 0.10.20
+            avg_in = -1
+        if avg_in > 0:
+            self.metrics.stream_rate(uri, avg_in)
+        if percent >= 100:
+            self.metrics.stall_ended(uri)
+        elif self.__state == "PLAYING" and self.__switch_started is None:
+            # Buffering before a track starts is part of starting it.
+            self.metrics.stall_started(uri)
 
     def __get_status(self):
         """ Return a string describing the current status of the
@@ -105,8 +580,10 @@ class Player(object):
                 track = self.__playlist[self.__current_track]
             except (TypeError, IndexError):
                 return self.__state
-            status = '%s: [%d/%d] %s' % (self.__state, self.__current_track + 1,
-                                         len(self.__playlist), track)
+            status = '%s: [%d/%d, album %d/%d] %s' % (
+                self.__state, self.__current_track + 1, len(self.__playlist),
+                self.__playlist.album_index(self.__current_track) + 1,
+                self.__playlist.album_count, track)
             if self.position and self.duration:
                 status = '%s [%0.1f/%0.1f sec]' % (status, self.position,
                                                    self.duration)
@@ -117,31 +594,47 @@ class Player(object):
     status = property(__get_status)
 
     def play(self):
+        with self.__lock:
+            self.__play()
+
+    def __play(self):
         if self.__state == "PAUSED":
-            self.__player.set_state(gst.STATE_PLAYING)
+            self.__playbin().set_state(gst.STATE_PLAYING)
             self.__state = "PLAYING"
         elif (self.__state == "PLAYING" and
               self.__current_track >= len(self.__playlist)):
-            self.__player.set_state(gst.STATE_NULL)
+            self.__playbin().set_state(gst.STATE_NULL)
             self.__state = "STOPPED"
         elif self.__playlist:
             track = self.__playlist[self.__current_track]
             #fd = track.request().fp.fileno()
-            self.__player.set_property('uri', track.uri)
-            self.__player.set_state(gst.STATE_PLAYING)
+            if self.__switch_started is None:
+                self.__switch_started = time.time()
+            playbin = self.__playbin()
+            playbin.set_property('uri', self.__track_uri(track))
+            playbin.set_state(gst.STATE_PLAYING)
             self.__state = "PLAYING"
             print self.status
 
     def pause(self):
-        self.__player.set_state(gst.STATE_PAUSED)
-        self.__state = "PAUSED"
-        print self.status
+        with self.__lock:
+            self.__playbin().set_state(gst.STATE_PAUSED)
+            self.__state = "PAUSED"
+            print self.status
 
     def stop(self):
-        self.__player.set_state(gst.STATE_NULL)
-        self.__state = "STOPPED"
-        self.__current_track = 0
-        print self.status
+        with self.__lock:
+            if self.__player is not None:
+                self.metrics.stall_ended(self.__player.get_property('uri'))
+                self.__player.set_state(gst.STATE_NULL)
+            self.__state = "STOPPED"
+            self.__current_track = 0
+            self.__queued_track = None
+            # Nothing is being switched to, e.g. after the last track
+            # ended; otherwise the next play would count the time
+            # stopped as its latency.
+            self.__switch_started = self.__eos_time = None
+            print self.status
 
     def __get_current_track(self):
         """ Return current track number (starts from 1, not 0). """
@@ -151,16 +644,20 @@ class Player(object):
         """ Move to given track. Note that track numbers start from 1, not
         0."""
         track = int(track)
-        self.__current_track = max(track, 1) - 1
-        self.__player.set_state(gst.STATE_NULL)
-        if self.__current_track >= len(self.__playlist):
-            self.stop()
-        elif self.__state == "PLAYING":
-            self.play()
-        elif self.__state == "PAUSED":
-            # If we switch tracks, we are no longer paused in the
-            # middle of one of them.
-            self.__state = "STOPPED"
+        with self.__lock:
+            self.__current_track = max(track, 1) - 1
+            self.__queued_track = None
+            if self.__player is not None:
+                self.metrics.stall_ended(self.__player.get_property('uri'))
+                self.__player.set_state(gst.STATE_NULL)
+            if self.__current_track >= len(self.__playlist):
+                self.stop()
+            elif self.__state == "PLAYING":
+                self.__play()
+            elif self.__state == "PAUSED":
+                # If we switch tracks, we are no longer paused in the
+                # middle of one of them.
+                self.__state = "STOPPED"
 
     current_track = property(__get_current_track, __set_current_track)
 
@@ -168,18 +665,35 @@ class Player(object):
         return self.__playlist
 
     def __set_playlist(self, playlist):
-        self.__playlist = playlist
-        self.current_track = 0
+        with self.__lock:
+            self.__playlist = playlist
+            self.current_track = 0
 
     playlist = property(__get_playlist, __set_playlist)
 
+    def __get_track_change_latency(self):
+        """ Return how long recent track changes took, from the
+        request to the new track playing. """
+        if not self.__latencies:
+            return 'No track changes yet, %d gapless' % self.__gapless_switches
+        latencies = list(self.__latencies)
+        return ('last %0.1f ms, mean %0.1f ms, max %0.1f ms over %d track '
+                'changes, %d gapless' % (
+                    1e3 * latencies[-1], 1e3 * sum(latencies) / len(latencies),
+                    1e3 * max(latencies), len(latencies),
+                    self.__gapless_switches))
+
+    track_change_latency = property(__get_track_change_latency)
+
     def next(self, incr=1):
         """ Move to the next track. """
-        self.current_track += incr
+        with self.__lock:
+            self.current_track += incr
 
     def prev(self, decr=1):
         """ Move to the previous track. """
-        self.current_track -= decr
+        with self.__lock:
+            self.current_track -= decr
 
     def __set_volume(self, volume):
         """ volume should be between 0.0 and 10.0 """
@@ -188,10 +702,10 @@ class Player(object):
             volume = 10.0
         elif volume < 0.0:
             volume = 0.0
-        self.__player.set_property('volume', volume)
+        self.__playbin().set_property('volume', volume)
 
     def __get_volume(self):
-        return self.__player.get_property('volume')
+        return self.__playbin().get_property('volume')
 
     volume = property(__get_volume, __set_volume)
 
@@ -201,10 +715,43 @@ class Player(object):
     def seek(self, time_sec):
         """ Seek to the given position (in seconds). """
         time_ns = time_sec * 1e9
-        self.__player.seek_simple(gst.Format(gst.FORMAT_TIME),
-                                 gst.SEEK_FLAG_FLUSH, time_ns)
+        with self.__lock:
+            playbin = self.__playbin()
+            offset = self.__seek_offset(time_sec)
+            # Straight to the right frame, with a single Range request,
+            # instead of having GStreamer guess or scan.  Not every
+            # pipeline takes byte seeks, so fall back to a time seek.
+            if (offset is None or
+                not playbin.seek_simple(gst.Format(gst.FORMAT_BYTES),
+                                        gst.SEEK_FLAG_FLUSH, offset)):
+                playbin.seek_simple(gst.Format(gst.FORMAT_TIME),
+                                    gst.SEEK_FLAG_FLUSH, time_ns)
+
+    def __seek_offset(self, time_sec):
+        """ Return the byte offset of the given time in the current
+        track, if it is streamed over HTTP and has a seek index.  The
+        index is only built the first time a track is seeked in, and
+        not while the track cache is downloading the track anyway. """
+        if not self.seek_indexes or self.__queued_track is not None:
+            # The uri is already that of the queued track.
+            return None
+        uri = self.__player.get_property('uri')
+        if not uri or not uri.startswith('http'):
+            return None
+        try:
+            track = self.__playlist[self.__current_track]
+        except IndexError:
+            return None
+        index = self.seek_indexes.get(track)
+        if index is None:
+            if not (self.cache and self.cache.fetching(track)):
+                self.seek_indexes.prepare(track, uri)
+            return None
+        return index.offset(time_sec)
 
     def __get_position(self):
+        if self.__player is None:
+            return None
         try:
             pos = 1e-9 * self.__player.query_position(
                 gst.Format(gst.FORMAT_TIME), None)[0]
@@ -212,171 +759,2828 @@ class Player(object):
             pos = None
         return pos
 
-    position = property(__get_position, seek)
+    position = property(__get_position, seek)
+
+    def ff(self, time=10):
+        """ Fast forward """
+        self.position += time
+
+    def rew(self, time=10):
+        """ Rewind """
+        self.position -= time
+
+    def __get_duration(self):
+        if self.__player is None:
+            return None
+        try:
+            dur = 1e-9 * self.__player.query_duration(
+                gst.Format(gst.FORMAT_TIME), None)[0]
+        except gst.QueryError:
+            dur = None
+        return dur
+
+    duration = property(__get_duration)
+
+
+class QueryCache(object):
+    """
+    Bounded LRU cache of search results.
+
+    Each result is stored with the generation of the tracks it was
+    computed from, and is only reused while that generation is
+    current, so the owner just has to bump its generation whenever its
+    tracks change.  Cached results are shared, so they must not be
+    modified.
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        return ('%d cached queries, %d hits, %d misses (%0.0f%% hit rate)'
+                % (len(self.__entries), self.hits, self.misses,
+                   100.0 * self.hits / (lookups or 1)))
+
+    def __getstate__(self):
+        # Results are cheap to recompute, don't save them.
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+    def search(self, pattern, fields, flags, generation, search):
+        """ Return search(pattern, fields, flags), reusing the result
+        of an earlier search for the same query and generation. """
+        # The order of the fields and repeated fields don't change
+        # the result.
+        key = (pattern, tuple(sorted(set(fields))), flags)
+        entry = self.__entries.pop(key, None)
+        if entry is not None and entry[0] == generation:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (generation, search(pattern, fields, flags))
+        self.__entries[key] = entry
+        while len(self.__entries) > self.size:
+            self.__entries.popitem(last=False)
+        return entry[1]
+
+    def clear(self):
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class _ChangeTrackingList(list):
+    """
+    List that calls self._changed(start) after every modification,
+    where start is the index of the first item that may have changed.
+    """
+    def __init__(self, items=()):
+        list.__init__(self)
+        self.extend(items)
+
+    def _changed(self, start):
+        pass
+
+    def append(self, item):
+        list.append(self, item)
+        self._changed(len(self) - 1)
+
+    def extend(self, items):
+        start = len(self)
+        list.extend(self, items)
+        self._changed(start)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._changed(0)
+
+    def remove(self, item):
+        list.remove(self, item)
+        self._changed(0)
+
+    def pop(self, *args):
+        item = list.pop(self, *args)
+        self._changed(0)
+        return item
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed(0)
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed(0)
+
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self._changed(0)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed(0)
+
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, items)
+        self._changed(0)
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed(0)
+
+
+class Playlist(_ChangeTrackingList):
+    """
+    List of tracks that keeps an index of where each album starts, so
+    that moving between albums doesn't have to look at every track.
+    """
+    # Index of the first track of each run of tracks from the same
+    # album, and the corresponding albums.
+    __album_starts = None
+    __albums = None
+
+    # Bumped on every change, so that cached searches are recomputed.
+    generation = 0
+    query_cache = None
+
+    def _changed(self, start):
+        self.generation += 1
+        if self.__album_starts is None:
+            self.__album_starts = []
+            self.__albums = []
+            start = 0
+        # Only the runs starting before start are still valid.
+        n = bisect.bisect_left(self.__album_starts, start)
+        del self.__album_starts[n:]
+        del self.__albums[n:]
+        for n in xrange(start, len(self)):
+            album = self[n].album
+            if not self.__albums or album != self.__albums[-1]:
+                self.__album_starts.append(n)
+                self.__albums.append(album)
+
+    def album_index(self, track):
+        """ Return the index of the album run containing the given
+        track (counting from 0). """
+        return bisect.bisect_right(self.__album_starts, track) - 1
+
+    def album_start(self, index):
+        """ Return the first track of the given album run. """
+        return self.__album_starts[index]
+
+    def __get_album_count(self):
+        """ Number of album runs in the playlist. """
+        return len(self.__album_starts or [])
+
+    album_count = property(__get_album_count)
+
+    def shuffle(self):
+        tracks = list(self)
+        random.shuffle(tracks)
+        self[:] = tracks
+
+    def shuffle_albums(self):
+        runs = {}
+        ends = self.__album_starts[1:] + [len(self)]
+        for start, end, album in zip(self.__album_starts, ends,
+                                     self.__albums):
+            runs.setdefault(album, []).append(list.__getslice__(self, start,
+                                                                end))
+        albums = runs.keys()
+        random.shuffle(albums)
+        tracks = []
+        starts = []
+        for album in albums:
+            starts.append(len(tracks))
+            for run in runs[album]:
+                tracks.extend(run)
+        # Rebuild the index directly instead of looking at every
+        # track's album again.
+        list.__setslice__(self, 0, len(self), tracks)
+        self.__album_starts = starts
+        self.__albums = albums
+        self.generation += 1
+
+    def clear(self):
+        self.__delslice__(0, len(self))
+
+    def search(self, pattern, fields=("artist", "album", "name"),
+               flags=re.IGNORECASE):
+        """ Return the numbers of all tracks matching the given
+        pattern. """
+        if self.query_cache is None:
+            self.query_cache = QueryCache()
+        return self.query_cache.search(pattern, fields, flags,
+                                       self.generation, self._search)
+
+    def _search(self, pattern, fields, flags):
+        pat = re.compile(pattern, flags)
+        tracknums = []
+        for n,x in enumerate(self):
+            for y in fields:
+                if getattr(x, y) and pat.search(getattr(x, y)):
+                    tracknums.append(n)
+                    break
+        return tracknums
+
+    def lines(self, start=0, stop=None):
+        """ Yield a numbered line for each track from start to stop. """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        for n in xrange(start, stop):
+            yield '%d: %s' % (n+1, self[n])
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+class PrefixTrie(object):
+    """
+    Set of strings that can be looked up by (case insensitive) prefix,
+    for tab completion.  Edges are labelled with whole substrings
+    rather than single characters, so there are at most twice as many
+    nodes as strings.  Strings can be added by one thread (the loader)
+    while another completes.
+    """
+
+    def __init__(self, words=()):
+        # A node is a pair (children, words), where children maps the
+        # first character of each edge to [label, node].
+        self.__root = ({}, [])
+        self.__len = 0
+        self.__lock = threading.Lock()
+        for x in words:
+            self.add(x)
+
+    def __len__(self):
+        return self.__len
+
+    def __getstate__(self):
+        # Locks can't be pickled.
+        state = self.__dict__.copy()
+        del state['_PrefixTrie__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+
+    def add(self, word):
+        with self.__lock:
+            self.__add(word)
+
+    def __add(self, word):
+        key = word.lower()
+        node = self.__root
+        while key:
+            edge = node[0].get(key[0])
+            if edge is None:
+                child = ({}, [])
+                node[0][key[0]] = [key, child]
+                node = child
+                break
+            label, child = edge
+            n = 1
+            while n < min(len(label), len(key)) and label[n] == key[n]:
+                n += 1
+            if n < len(label):
+                # Split the edge where key branches off.
+                child = ({label[n]: [label[n:], child]}, [])
+                edge[:] = [label[:n], child]
+            node = child
+            key = key[n:]
+        if word not in node[1]:
+            node[1].append(word)
+            self.__len += 1
+
+    def __find(self, prefix):
+        """ Return the node below which all keys start with prefix. """
+        key = prefix.lower()
+        node = self.__root
+        while key:
+            edge = node[0].get(key[0])
+            if edge is None:
+                return None
+            label, node = edge
+            if label.startswith(key):
+                break
+            elif not key.startswith(label):
+                return None
+            key = key[len(label):]
+        return node
+
+    def __contains__(self, word):
+        with self.__lock:
+            node = self.__find(word)
+            return node is not None and word in node[1]
+
+    def complete(self, prefix):
+        """ Return all strings starting with prefix, sorted. """
+        words = []
+        with self.__lock:
+            node = self.__find(prefix)
+            stack = node and [node] or []
+            while stack:
+                node = stack.pop()
+                words.extend(node[1])
+                stack.extend([x[1] for x in node[0].itervalues()])
+        words.sort()
+        return words
+
+
+class BaseCollection(object):
+    """Base representation of a music collection."""
+    # Set while tracks are being loaded in the background.
+    loading = False
+    load_error = None
+    load_time = None
+    expected_tracks = None
+
+    # Fields whose values can be tab completed.
+    completion_fields = ('artist', 'album', 'genre')
+    __completions = None
+
+    # Bumped whenever the tracks change, so that cached searches are
+    # recomputed.
+    generation = 0
+    query_cache = None
+
+    def init(self):
+        self.sort_tracks(self.tracks)
+        self.generation += 1
+
+    def load(self, batches, background=False, tracks=None):
+        """ Load tracks from an iterator over lists of tracks.
+
+        If background is True, the tracks are loaded by a separate
+        thread and each batch can be searched as soon as it has been
+        loaded.  The collection is only sorted once all batches are in.
+
+        The tracks are stored in a list unless some other container,
+        such as SqliteTracks, is given.
+        """
+        if tracks is None:
+            tracks = []
+        self.tracks = tracks
+        self.generation += 1
+        self.__completions = None
+        self._add_completions([])
+        self.loading = True
+        self.load_error = None
+        self.__load_started = time.time()
+        if background:
+            loader = threading.Thread(target=self.__load_in_background,
+                                      args=(batches,))
+            loader.setDaemon(True)
+            loader.start()
+        else:
+            self.__load(batches)
+
+    def __load(self, batches):
+        try:
+            for batch in batches:
+                self.tracks.extend(batch)
+                self.generation += 1
+                self._add_completions(batch)
+            if isinstance(self.tracks, list):
+                tracks = list(self.tracks)
+                self.sort_tracks(tracks)
+                # Swap in the sorted tracks in one go, so that searches
+                # running in the meantime never see a half sorted list.
+                self.tracks = tracks
+                self.generation += 1
+        finally:
+            self.loading = False
+            self.load_time = time.time() - self.__load_started
+
+    def __load_in_background(self, batches):
+        try:
+            self.__load(batches)
+        except Exception, e:
+            self.load_error = e
+
+    def __get_progress(self):
+        """ Return a string describing how far loading has got. """
+        if self.loading:
+            progress = 'Loading: %d' % len(self.tracks)
+            if self.expected_tracks:
+                progress += ' of %d' % self.expected_tracks
+            return '%s tracks after %0.1f sec' % (
+                progress, time.time() - self.__load_started)
+        elif self.load_error:
+            return 'Loading failed after %d tracks: %s' % (len(self.tracks),
+                                                           self.load_error)
+        elif self.load_time is not None:
+            return 'Loaded %d tracks in %0.1f sec' % (len(self.tracks),
+                                                      self.load_time)
+        else:
+            return 'Loaded %d tracks' % len(self.tracks)
+
+    progress = property(__get_progress)
+
+    def _add_completions(self, tracks):
+        """ Make the values of the given tracks available for tab
+        completion. """
+        if self.__completions is None:
+            self.__completions = dict([(x, PrefixTrie())
+                                       for x in self.completion_fields])
+        for x in tracks:
+            for field, trie in self.__completions.iteritems():
+                val = getattr(x, field, None)
+                if val:
+                    trie.add(val)
+
+    def complete(self, prefix, fields=None):
+        """ Return the values of the given fields (by default all
+        completion_fields) that start with prefix. """
+        if self.__completions is None:
+            # Collections that weren't loaded with load().
+            self._add_completions(self.tracks)
+        if fields is None:
+            fields = self.completion_fields
+        values = set()
+        for x in fields:
+            if x in self.__completions:
+                values.update(self.__completions[x].complete(prefix))
+        return sorted(values)
+
+    def sort_tracks(self, tracks):
+        """ Sort tracks (in place) in some reasonable order. """
+        for x in ['uri', 'track', 'disc', 'album', 'year', 'artist']:
+            tracks.sort(key=operator.attrgetter(x))
+    
+    def search(self, pattern, fields=("artist", "album", "name"),
+               flags=re.IGNORECASE):
+        """ Return all tracks matching the given pattern. """
+        if self.query_cache is None:
+            self.query_cache = QueryCache()
+        return self.query_cache.search(pattern, fields, flags,
+                                       self.generation, self._search)
+
+    def _search(self, pattern, fields, flags):
+        if hasattr(self.tracks, 'search'):
+            return self.tracks.search(pattern, fields, flags)
+        pat = re.compile(pattern, flags)
+        tracks = Playlist()
+        for x in self.tracks:
+            for y in fields:
+                if getattr(x, y) and pat.search(getattr(x, y)):
+                    tracks.append(x)
+                    break
+        return tracks
+
+
+class SessionStore(object):
+    """
+    DAAP sessions kept between runs of the player.
+
+    For each server, the session id and what the client learned while
+    connecting are saved, so that the next connection to it can skip
+    the content codes, server info and login requests as long as the
+    server still honours the session.
+    """
+    def __init__(self, filename='~/.daap_player_sessions'):
+        self.filename = os.path.expanduser(filename)
+        self.__lock = threading.Lock()
+
+    def __load(self):
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                return pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # Missing or unreadable, start afresh.
+            return {}
+
+    def __save(self, sessions):
+        tmpfile = self.filename + '.tmp'
+        # Session ids are as good as the password.
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        f = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(sessions, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpfile, self.filename)
+
+    def get(self, server, port):
+        """ Return the (sessionid, client state) saved for the given
+        server, or None. """
+        with self.__lock:
+            return self.__load().get((server, port))
+
+    def put(self, server, port, session):
+        """ Save the given DAAPSession for the server. """
+        with self.__lock:
+            sessions = self.__load()
+            sessions[(server, port)] = (session.sessionid,
+                                        session.connection.getState())
+            self.__save(sessions)
+
+    def remove(self, server, port):
+        with self.__lock:
+            sessions = self.__load()
+            if sessions.pop((server, port), None):
+                self.__save(sessions)
+
+
+# host:port -> the DAAPSession tracks streamed from that server are
+# played with.
+_daap_sessions = {}
+_daap_sessions_lock = threading.Lock()
+# The host:ports in _daap_sessions whose session _daap_session opened
+# itself, rather than a DaapCollection, see _close_daap_sessions.
+_daap_sessions_opened = set()
+
+
+def _daap_session(netloc):
+    """ Return a DAAPSession for the server at netloc (host:port): the
+    one of a DaapCollection loaded from it, or else the one saved in
+    DaapCollection.session_store or a new login. """
+    with _daap_sessions_lock:
+        if netloc in _daap_sessions:
+            return _daap_sessions[netloc]
+        session = None
+        host, sep, port = netloc.rpartition(':')
+        try:
+            client = daap.DAAPClient()
+            store = DaapCollection.session_store
+            saved = store and store.get(host, int(port))
+            if saved:
+                client.connect(host, int(port), state=saved[1])
+                session = client.resume(saved[0])
+                # Logs in again if the server has expired the session.
+                session.update()
+            else:
+                client.connect(host, int(port))
+                session = client.login()
+        except Exception, e:
+            # Not remembered, the server may be back next time.
+            print "Error connecting to %s: %s" % (netloc, e)
+            return None
+        _daap_sessions[netloc] = session
+        _daap_sessions_opened.add(netloc)
+        return session
+
+
+def _close_daap_sessions():
+    """ Save the sessions opened by _daap_session to
+    DaapCollection.session_store for next time, or log out of them if
+    there is none. """
+    with _daap_sessions_lock:
+        sessions = [(x, _daap_sessions.pop(x, None))
+                    for x in _daap_sessions_opened]
+        _daap_sessions_opened.clear()
+    for netloc, session in sessions:
+        if session is None:
+            continue
+        host, sep, port = netloc.rpartition(':')
+        try:
+            if DaapCollection.session_store:
+                DaapCollection.session_store.put(host, int(port), session)
+            else:
+                session.logout()
+        except Exception, e:
+            print "Error closing session with %s: %s" % (netloc, e)
+
+
+def _daap_base_uri(uri):
+    """ Return the uri of a streamed track without the session id,
+    which is only good while the session lasts. """
+    if uri and uri.startswith('http://'):
+        return uri.split('?', 1)[0]
+    return uri
+
+
+def _daap_live_uri(uri):
+    """ Return the uri of a stored track, with the id of a current
+    session for streamed ones. """
+    uri = _daap_base_uri(uri)
+    if not uri or not uri.startswith('http://'):
+        return uri
+    session = _daap_session(urlparse.urlsplit(uri).netloc)
+    if session is None:
+        return uri
+    return '%s?session-id:%d' % (uri, session.sessionid)
+
+
+class DaapCollection(BaseCollection):
+    """Music collection contained on a DAAP server."""
+    # Libraries with at least this many tracks are decoded by the
+    # worker processes of daap.startPool, started for the first one
+    # unless -p started them already.
+    parallel_tracks = 50000
+    # Where sessions are kept for the next run, None to log out
+    # instead.
+    session_store = SessionStore()
+    # (generation, {DAAP id: track}) for playlist_tracks.
+    __tracks_by_id = None
+
+    def __init__(self, server='localhost', port=3689, password=None,
+                 background=False, dbfile=None):
+        self.__session = None
+        self.__server = (server, port)
+        started = time.time()
+        client = daap.DAAPClient();
+        saved = None
+        if self.session_store:
+            saved = self.session_store.get(server, port)
+        if saved:
+            sessionid, state = saved
+            client.connect(server, port=port, password=password,
+                           state=state)
+            self.__session = client.resume(sessionid)
+        else:
+            client.connect(server, port=port, password=password)
+            self.__session = client.login()
+        library = self.__session.library()
+        netloc = '%s:%d' % (server, port)
+        with _daap_sessions_lock:
+            # Stored tracks from this server are played with it too,
+            # instead of any session opened for them before.
+            replaced = None
+            if netloc in _daap_sessions_opened:
+                replaced = _daap_sessions[netloc]
+                _daap_sessions_opened.discard(netloc)
+            _daap_sessions[netloc] = self.__session
+        # Both may have resumed the same saved session.
+        if (replaced is not None and
+            replaced.sessionid != self.__session.sessionid):
+            try:
+                replaced.logout()
+            except Exception, e:
+                print "Error closing session with %s: %s" % (netloc, e)
+        # Time taken to log in and find the library, used to pick the
+        # fastest server for tracks available on several of them.
+        self.login_time = time.time() - started
+        if self.session_store:
+            self.session_store.put(server, port, self.__session)
+        # Fetch the playlists while the tracks are loading, so they can
+        # be browsed straight away.
+        prefetcher = threading.Thread(target=self.__prefetch)
+        prefetcher.setDaemon(True)
+        prefetcher.start()
+        self.expected_tracks = library.count
+        tracks = None
+        if dbfile:
+            tracks = SqliteTracks(dbfile, clear=True)
+        # Large libraries are decoded by worker processes, if there is
+        # more than one CPU to run them.
+        processes = 1
+        if (self.expected_tracks >= self.parallel_tracks and
+            multiprocessing.cpu_count() > 1):
+            daap.startPool()
+            processes = None
+        self.load(library.iterTracks(processes=processes), background, tracks)
+ 
+    def __del__(self):
+        # Collections pickled before sessions were kept have neither.
+        session = getattr(self, '_DaapCollection__session', None)
+        server = getattr(self, '_DaapCollection__server', None)
+        if not session:
+            return
+        if self.session_store and server:
+            # Keep the session for next time, with the latest request id.
+            self.session_store.put(server[0], server[1], session)
+            return
+        if server:
+            with _daap_sessions_lock:
+                netloc = '%s:%d' % server
+                if _daap_sessions.get(netloc) is session:
+                    del _daap_sessions[netloc]
+        session.logout()
+
+    def __prefetch(self):
+        try:
+            self.__session.prefetch()
+        except Exception, e:
+            print "Error fetching playlists:", e
+
+    def playlists(self):
+        """ Return the playlists on the server. """
+        return self.__session.library().playlists()
+
+    def playlist_tracks(self, playlist):
+        """ Return the tracks of the given playlist on the server, in
+        order. """
+        if not isinstance(self.tracks, list):
+            # Tracks in other containers don't know their DAAP ids.
+            return Playlist(playlist.tracks())
+        by_id = self.__tracks_by_id
+        if by_id is None or by_id[0] != self.generation:
+            by_id = (self.generation,
+                     dict([(x.id, x) for x in self.tracks]))
+            self.__tracks_by_id = by_id
+        return Playlist([by_id[1][x] for x in playlist.itemIds()
+                         if x in by_id[1]])
+
+    def logout(self):
+        """ End the session, instead of keeping it for next time. """
+        if self.__session:
+            if self.session_store:
+                server, port = self.__server
+                self.session_store.remove(server, port)
+            self.__session.logout()
+            self.__session = None
+
+
+class DirectoryCollection(BaseCollection):
+    """Music collection contained on the filesystem."""
+    verbose = True
+
+    def __init__(self, basedir, extensions=['mp3', 'ogg', 'flac', 'wav'],
+                 background=False, dbfile=None, verbose=None):
+        self.basedir = os.path.abspath(os.path.expanduser(basedir))
+        self.extensions = [x.lower() for x in extensions]
+        self.watcher = None
+        # Don't print every file we load while the shell is in use.
+        if verbose is None:
+            verbose = not background
+        self.verbose = verbose
+        # Artist, album and genre strings shared by the tracks, see Track.
+        self.strings = {}
+        tracks = None
+        if dbfile:
+            tracks = SqliteTracks(dbfile, clear=True)
+        self.load(self.iter_scan(self.basedir), background, tracks)
+
+    def __getstate__(self):
+        # The watcher thread can't be pickled, and the shared strings
+        # are rebuilt from the tracks.
+        state = self.__dict__.copy()
+        state['watcher'] = None
+        state.pop('strings', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.strings = {}
+        if isinstance(self.tracks, list):
+            for x in self.tracks:
+                x.album = _intern(self.strings, x.album)
+                x.artist = _intern(self.strings, x.artist)
+                x.genre = _intern(self.strings, x.genre)
+
+    def is_audio_file(self, filename):
+        return os.path.splitext(filename)[-1][1:].lower() in self.extensions
+
+    def iter_scan(self, basedir, batchsize=100):
+        """ Yield lists of Tracks for the audio files below basedir. """
+        batch = []
+        for path, dirs, files in os.walk(basedir):
+            for x in files:
+                if self.is_audio_file(x):
+                    batch.append(Track(os.path.join(path, x), self.verbose,
+                                       self.strings))
+                    if len(batch) >= batchsize:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+    def scan(self, basedir):
+        """ Return Tracks for all audio files below basedir. """
+        tracks = []
+        for batch in self.iter_scan(basedir):
+            tracks.extend(batch)
+        return tracks
+
+    def watch(self, delay=1.0, max_delay=10.0):
+        """ Keep the collection up to date with changes on disk.
+        Changes are applied once the directory tree has been quiet
+        for delay seconds, or at the latest max_delay seconds after
+        the first of them. """
+        if not isinstance(self.tracks, list):
+            raise ValueError("Can't watch collections stored on disk.")
+        if not self.watcher:
+            self.watcher = DirectoryWatcher(self, delay, max_delay)
+
+    def unwatch(self):
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+
+    def apply_changes(self, updated, removed, renamed):
+        """ Update the collection in response to changes on disk.
+
+        updated is a list of files or directories whose tracks need to
+        be (re)read, removed a list of deleted files or directories,
+        and renamed a list of (old, new) paths, applied in order
+        before anything else.  Only the tracks involved are touched.
+        """
+        def below(filename, path):
+            return filename == path or filename.startswith(path + os.sep)
+
+        tracks = list(self.tracks)
+        for old, new in renamed:
+            for x in tracks:
+                if below(x.filename, old):
+                    x.set_filename(new + x.filename[len(old):])
+        gone = set(removed + updated)
+        def is_gone(filename):
+            while len(filename) > len(self.basedir):
+                if filename in gone:
+                    return True
+                filename = os.path.dirname(filename)
+            return filename in gone
+        if gone:
+            tracks = [x for x in tracks if not is_gone(x.filename)]
+        for path in updated:
+            if is_gone(os.path.dirname(path)):
+                # Already picked up by scanning its parent directory.
+                continue
+            elif os.path.isdir(path):
+                new_tracks = self.scan(path)
+                tracks.extend(new_tracks)
+                self._add_completions(new_tracks)
+            elif os.path.isfile(path) and self.is_audio_file(path):
+                tracks.append(Track(path, self.verbose, self.strings))
+                self._add_completions(tracks[-1:])
+        self.sort_tracks(tracks)
+        # Swap the list in one go so readers never see a partial update.
+        self.tracks = tracks
+        self.generation += 1
+
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+
+class DirectoryWatcher(object):
+    """
+    Watches a DirectoryCollection's basedir with Linux inotify and
+    applies changes to the collection as they happen.
+
+    Events are coalesced per path and only applied once the tree has
+    been quiet for delay seconds, so copying a whole album results in
+    one tag read per file and a single update of the collection.  A
+    file that keeps changing, like a download in progress, doesn't hold
+    up the other changes for more than max_delay seconds though.
+    Renames are applied without rereading any tags.
+    """
+    event_mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+
+    def __init__(self, collection, delay=1.0, max_delay=10.0):
+        import ctypes
+        import ctypes.util
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                  use_errno=True)
+        self.__fd = self.__libc.inotify_init()
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.__wakeup = os.pipe()
+
+        self.collection = collection
+        self.delay = delay
+        self.max_delay = max_delay
+        # paths that need to be updated or removed
+        self.__pending = set()
+        # times of the first and last events since the last flush
+        self.__first_event = 0
+        self.__last_event = 0
+        # renames (old, new) in the order they happened
+        self.__renamed = []
+        # cookie -> path for IN_MOVED_FROM events that haven't (yet)
+        # been matched by an IN_MOVED_TO
+        self.__moved = {}
+        self.__watches = {}
+        self.__add_watches(collection.basedir)
+
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        os.write(self.__wakeup[1], 'x')
+        self.__thread.join()
+        os.close(self.__fd)
+        for fd in self.__wakeup:
+            os.close(fd)
+
+    def __add_watches(self, basedir):
+        for path, dirs, files in os.walk(basedir):
+            wd = self.__libc.inotify_add_watch(self.__fd, path,
+                                               self.event_mask)
+            if wd >= 0:
+                self.__watches[wd] = path
+
+    def __remove_watches(self, basedir):
+        for wd, path in self.__watches.items():
+            if path == basedir or path.startswith(basedir + os.sep):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+
+    def __rename_watches(self, old, new):
+        for wd, path in self.__watches.items():
+            if path == old or path.startswith(old + os.sep):
+                self.__watches[wd] = new + path[len(old):]
+
+    def __run(self):
+        while self.__running:
+            timeout = None
+            if self.__pending or self.__moved or self.__renamed:
+                due = min(self.__last_event + self.delay,
+                          self.__first_event + self.max_delay)
+                timeout = max(due - time.time(), 0)
+            ready = select.select([self.__fd, self.__wakeup[0]], [], [],
+                                  timeout)[0]
+            if self.__fd in ready:
+                self.__read_events(os.read(self.__fd, 64 * 1024))
+            elif not ready:
+                self.__flush()
+
+    def __read_events(self, data):
+        self.__last_event = time.time()
+        if not (self.__pending or self.__moved or self.__renamed):
+            self.__first_event = self.__last_event
+        header = struct.calcsize('iIII')
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data,
+                                                          offset)
+            name = data[offset + header:offset + header + length]
+            offset += header + length
+            if mask & IN_Q_OVERFLOW:
+                print 'inotify queue overflowed, rescanning %s' % (
+                    self.collection.basedir)
+                self.__pending.add(self.collection.basedir)
+                continue
+            elif mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+            elif wd not in self.__watches:
+                continue
+            path = os.path.join(self.__watches[wd], name.rstrip('\0'))
+
+            if mask & IN_MOVED_FROM:
+                self.__moved[cookie] = path
+            elif mask & IN_MOVED_TO and cookie in self.__moved:
+                old = self.__moved.pop(cookie)
+                self.__renamed.append((old, path))
+                self.__rename_watches(old, path)
+                for x in list(self.__pending):
+                    if x == old or x.startswith(old + os.sep):
+                        self.__pending.remove(x)
+                        self.__pending.add(path + x[len(old):])
+            else:
+                self.__pending.add(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__add_watches(path)
+
+    def __flush(self):
+        removed = self.__moved.values()
+        for path in removed:
+            # Moved out of the tree, so any directories in it are no
+            # longer of interest.
+            self.__remove_watches(path)
+        updated = []
+        for path in self.__pending:
+            if os.path.exists(path):
+                updated.append(path)
+            else:
+                removed.append(path)
+        renamed = self.__renamed
+        self.__pending = set()
+        self.__moved = {}
+        self.__renamed = []
+        try:
+            self.collection.apply_changes(updated, removed, renamed)
+        except Exception, e:
+            print "Error updating collection:", e
+
+
+def _intern(strings, string):
+    """ Return the copy of the given (unicode) string kept in the dict
+    strings, adding it if needed.  The builtin intern only handles
+    byte strings, and would keep them for good. """
+    if string is None:
+        return None
+    return strings.setdefault(string, string)
+
+
+# Reading tags straight from the file headers.  Opening every file of a
+# big directory through tagpy is slow, while the tags and what is needed
+# to work out the length are almost always in the first few kilobytes.
+
+_id3v2_frames = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'TRCK': 'track',
+    'TPOS': 'disc', 'TYER': 'year', 'TDRC': 'year', 'TCON': 'genre',
+    # ID3v2.2
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'TRK': 'track',
+    'TPA': 'disc', 'TYE': 'year', 'TCO': 'genre',
+}
+
+_vorbis_comments = {
+    'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album',
+    'TRACKNUMBER': 'track', 'DISCNUMBER': 'disc', 'DATE': 'year',
+    'GENRE': 'genre',
+}
+
+# The genres numbered by ID3v1, which ID3v2 genres can refer to as
+# "(n)" or "n".
+_id3v1_genres = [
+    'Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk',
+    'Grunge', 'Hip-Hop', 'Jazz', 'Metal', 'New Age', 'Oldies', 'Other',
+    'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', 'Industrial',
+    'Alternative', 'Ska', 'Death Metal', 'Pranks', 'Soundtrack',
+    'Euro-Techno', 'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion',
+    'Trance', 'Classical', 'Instrumental', 'Acid', 'House', 'Game',
+    'Sound Clip', 'Gospel', 'Noise', 'AlternRock', 'Bass', 'Soul',
+    'Punk', 'Space', 'Meditative', 'Instrumental Pop',
+    'Instrumental Rock', 'Ethnic', 'Gothic', 'Darkwave',
+    'Techno-Industrial', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream',
+    'Southern Rock', 'Comedy', 'Cult', 'Gangsta', 'Top 40',
+    'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', 'Cabaret',
+    'New Wave', 'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi',
+    'Tribal', 'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical',
+    'Rock & Roll', 'Hard Rock',
+]
+
+_id3v2_encodings = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+
+def _tag_number(value):
+    """ Return the leading number of a tag value like "3/12" or
+    "1999-05-01", or None. """
+    match = re.match(r'\s*(\d+)', value)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def _set_tag(tags, field, value):
+    if field in tags or not value:
+        return
+    if field in ('track', 'disc', 'year'):
+        value = _tag_number(value)
+        if value is None:
+            return
+    elif field == 'genre':
+        match = re.match(r'\((\d+)\)(.*)$|(\d+)$', value)
+        if match:
+            number = int(match.group(1) or match.group(3))
+            if match.group(2):
+                value = match.group(2)
+            elif number < len(_id3v1_genres):
+                value = unicode(_id3v1_genres[number])
+            else:
+                return
+    tags[field] = value
+
+
+def _read_id3v2(buf):
+    """ Return the text fields of the ID3v2 tag at the start of buf, or
+    None if buf doesn't hold all of it or it can't be read without
+    undoing unsynchronisation. """
+    size = _id3v2_size(buf)
+    if not size or size > len(buf):
+        return None
+    version = ord(buf[3])
+    flags = ord(buf[5])
+    if version not in (2, 3, 4) or flags & 0x80:
+        return None
+    pos = 10
+    end = 10 + _syncsafe(buf[6:10])
+    if flags & 0x40 and version == 3:
+        pos += 4 + struct.unpack('>I', buf[10:14])[0]
+    elif flags & 0x40 and version == 4:
+        pos += _syncsafe(buf[10:14])
+    if version == 2:
+        idsize, headersize = 3, 6
+    else:
+        idsize, headersize = 4, 10
+    tags = {}
+    while pos + headersize <= end:
+        frameid = buf[pos:pos + idsize]
+        if not frameid.strip('\0'):
+            # Padding
+            break
+        if version == 2:
+            framesize = struct.unpack('>I', '\0' + buf[pos + 3:pos + 6])[0]
+            skip = False
+        elif version == 3:
+            framesize = struct.unpack('>I', buf[pos + 4:pos + 8])[0]
+            # Compressed or encrypted
+            skip = ord(buf[pos + 9]) & 0xc0
+        else:
+            framesize = _syncsafe(buf[pos + 4:pos + 8])
+            # Compressed, encrypted, unsynchronised or with a length
+            skip = ord(buf[pos + 9]) & 0x0f
+        pos += headersize
+        data = buf[pos:pos + framesize]
+        pos += framesize
+        field = _id3v2_frames.get(frameid)
+        if field is None or skip or not data:
+            continue
+        encoding = _id3v2_encodings.get(ord(data[0]))
+        if encoding is None:
+            continue
+        try:
+            text = data[1:].decode(encoding)
+        except UnicodeError:
+            continue
+        # ID3v2.4 separates multiple values with NULs.
+        _set_tag(tags, field, text.split(u'\0')[0].strip())
+    return tags
+
+
+def _read_id3v1(data):
+    """ Return the fields of the 128 byte ID3v1 tag data, or None. """
+    if len(data) != 128 or data[:3] != 'TAG':
+        return None
+    def text(s):
+        return s.split('\0')[0].strip().decode('latin-1')
+    tags = {}
+    _set_tag(tags, 'title', text(data[3:33]))
+    _set_tag(tags, 'artist', text(data[33:63]))
+    _set_tag(tags, 'album', text(data[63:93]))
+    _set_tag(tags, 'year', text(data[93:97]))
+    if data[125] == '\0' and data[126] != '\0':
+        # ID3v1.1 keeps the track number at the end of the comment.
+        tags['track'] = ord(data[126])
+    if ord(data[127]) < len(_id3v1_genres):
+        tags['genre'] = unicode(_id3v1_genres[ord(data[127])])
+    return tags
+
+
+def _read_vorbis_comment(data, pos=0):
+    """ Return the fields of the Vorbis comment block at pos in data, or
+    None if it is cut short. """
+    try:
+        (vendor,) = struct.unpack_from('<I', data, pos)
+        pos += 4 + vendor
+        (count,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        tags = {}
+        for n in xrange(count):
+            (length,) = struct.unpack_from('<I', data, pos)
+            pos += 4
+            comment = data[pos:pos + length]
+            pos += length
+            if len(comment) != length:
+                return None
+            key, sep, value = comment.partition('=')
+            field = _vorbis_comments.get(key.upper())
+            if field is not None:
+                _set_tag(tags, field, value.decode('utf-8', 'replace'))
+        return tags
+    except struct.error:
+        return None
+
+
+def _read_mp3_header(buf, start, filesize, read_at):
+    tags = _read_id3v2(buf) if start else None
+    if start and tags is None:
+        return None
+    first, frame = _mp3_first_frame(buf, start)
+    if first is None:
+        return None
+    if not tags:
+        tags = _read_id3v1(read_at(filesize - 128, 128)) or {}
+    length, samples, samplerate, side = frame
+    frame_time = float(samples) / samplerate
+    frames = None
+    if buf[first + side:first + side + 4] in ('Xing', 'Info'):
+        p = first + side + 4
+        if len(buf) >= p + 8 and ord(buf[p + 3]) & 1:
+            frames = struct.unpack('>I', buf[p + 4:p + 8])[0]
+    elif buf[first + 36:first + 40] == 'VBRI' and len(buf) >= first + 54:
+        frames = struct.unpack('>I', buf[first + 50:first + 54])[0]
+    if frames:
+        tags['time'] = frames * frame_time
+    else:
+        # Constant bit rate, so the length follows from the size.
+        tags['time'] = (filesize - first) * frame_time / length
+    if tags['time']:
+        tags['bitrate'] = _kbps(filesize - first, tags['time'])
+    tags['format'] = 'mp3'
+    return tags
+
+
+def _read_flac_header(buf, start):
+    if buf[start:start + 4] != 'fLaC':
+        return None
+    tags = {}
+    comments = False
+    pos = start + 4
+    last = False
+    while not last:
+        if pos + 4 > len(buf):
+            return None
+        header = struct.unpack('>I', buf[pos:pos + 4])[0]
+        last = header >> 31
+        blocktype = (header >> 24) & 0x7f
+        size = header & 0xffffff
+        pos += 4
+        if blocktype == 0:
+            if pos + 18 > len(buf):
+                return None
+            info = struct.unpack('>Q', buf[pos + 10:pos + 18])[0]
+            samplerate = info >> 44
+            samples = info & 0xfffffffffL
+            if samplerate:
+                tags['time'] = float(samples) / samplerate
+        elif blocktype == 4:
+            if pos + size > len(buf):
+                return None
+            comment = _read_vorbis_comment(buf[pos:pos + size])
+            if comment is None:
+                return None
+            comment.update(tags)
+            tags = comment
+            comments = True
+        pos += size
+        if comments and 'time' in tags:
+            # Nothing more of interest, don't read through the pictures.
+            break
+    if 'time' not in tags:
+        return None
+    tags['format'] = 'flac'
+    return tags
+
+
+def _ogg_packets(buf):
+    """ Yield the packets of the Ogg pages in buf, ending with the last
+    one that is complete. """
+    packet = []
+    pos = 0
+    while buf[pos:pos + 4] == 'OggS' and pos + 27 <= len(buf):
+        count = ord(buf[pos + 26])
+        lacing = buf[pos + 27:pos + 27 + count]
+        pos += 27 + count
+        for x in lacing:
+            size = ord(x)
+            packet.append(buf[pos:pos + size])
+            pos += size
+            if size < 255:
+                yield ''.join(packet)
+                packet = []
+        if pos > len(buf):
+            break
+
+
+def _read_ogg_header(buf, filesize, read_at):
+    packets = _ogg_packets(buf)
+    try:
+        ident = packets.next()
+        comment = packets.next()
+    except StopIteration:
+        return None
+    if ident[:7] != '\x01vorbis' or comment[:7] != '\x03vorbis':
+        return None
+    tags = _read_vorbis_comment(comment, 7)
+    if tags is None:
+        return None
+    (samplerate,) = struct.unpack_from('<I', ident, 12)
+    (nominal,) = struct.unpack_from('<i', ident, 20)
+    # The position of the last page is the number of samples.
+    tail = read_at(max(filesize - 65536, 0), 65536)
+    pos = tail.rfind('OggS')
+    if pos < 0 or pos + 14 > len(tail) or not samplerate:
+        return None
+    (samples,) = struct.unpack_from('<q', tail, pos + 6)
+    tags['time'] = float(samples) / samplerate
+    if nominal > 0:
+        tags['bitrate'] = int(round(nominal / 1000.0))
+    tags['format'] = 'ogg'
+    return tags
+
+
+def _read_wav_header(buf):
+    pos = 12
+    byterate = None
+    while pos + 8 <= len(buf):
+        chunk, size = struct.unpack_from('<4sI', buf, pos)
+        pos += 8
+        if chunk == 'fmt ' and pos + 12 <= len(buf):
+            (byterate,) = struct.unpack_from('<I', buf, pos + 8)
+        elif chunk == 'data':
+            if not byterate:
+                return None
+            return {'time': float(size) / byterate, 'format': 'wav',
+                    'bitrate': _kbps(byterate, 1)}
+        pos += size + (size & 1)
+    return None
+
+
+def _kbps(nbytes, seconds):
+    return int(round(nbytes * 8 / 1000.0 / seconds))
+
+
+def read_header_tags(filename, size=65536):
+    """ Read the tags and length of the audio file filename from its
+    headers, going by its content rather than its name.
+
+    Only the first size bytes are read, plus the last few kilobytes where
+    the ID3v1 tag or the last Ogg page is.  Return a dict of the fields
+    found, with format, time and size (of the file) always among them,
+    or None if the file isn't MP3, Ogg Vorbis, FLAC or WAV or needs more
+    than that to read.
+    """
+    # os.pread needs Python 3, seek and read instead.
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        def read_at(offset, count):
+            os.lseek(fd, max(offset, 0), os.SEEK_SET)
+            return os.read(fd, count)
+        buf = os.read(fd, size)
+        filesize = os.fstat(fd).st_size
+        start = _id3v2_size(buf)
+        if buf[:4] == 'OggS':
+            tags = _read_ogg_header(buf, filesize, read_at)
+        elif buf[:4] == 'RIFF' and buf[8:12] == 'WAVE':
+            tags = _read_wav_header(buf)
+        elif buf[start:start + 4] == 'fLaC':
+            tags = _read_flac_header(buf, start)
+            if tags and tags['time']:
+                tags['bitrate'] = _kbps(filesize, tags['time'])
+        else:
+            tags = _read_mp3_header(buf, start, filesize, read_at)
+        if tags is not None:
+            tags['size'] = filesize
+        return tags
+    finally:
+        os.close(fd)
+
+
+class Track(object):
+    # tagpy file type -> format name, filled in on first use.
+    filetypes = {}
+
+    # Read tags from the file headers where possible, tagpy otherwise.
+    header_tags = True
+
+    # Collections can hold hundreds of thousands of tracks, so keep
+    # them small: no per-instance __dict__, shared strings for fields
+    # that repeat across tracks, and uri and name are derived from
+    # filename when needed.
+    __slots__ = ('filename', 'title', 'track', 'disc', 'album', 'year',
+                 'artist', 'genre', 'time', 'format', 'bitrate', 'size')
+
+    def __init__(self, filename, verbose=True, strings=None):
+        """ strings is a dict used to share artist, album and genre
+        strings with other tracks, normally one per collection. """
+        self.set_filename(filename)
+
+        if verbose:
+            print "Loading %s" % filename
+        if strings is None:
+            strings = {}
+        self._read_metadata_from_file(strings)
+
+    def set_filename(self, filename):
+        self.filename = filename
+
+    def __get_uri(self):
+        return 'file://%s' % urllib.quote(self.filename)
+
+    uri = property(__get_uri)
+
+    def __get_name(self):
+        if self.title is None:
+            return os.path.basename(self.filename)
+        return self.title
+
+    def __set_name(self, name):
+        self.title = name
+
+    name = property(__get_name, __set_name)
+
+    def __getstate__(self):
+        return dict([(x, getattr(self, x)) for x in self.__slots__])
+
+    def __setstate__(self, state):
+        # Tracks pickled before __slots__ was used store name and uri
+        # instead of title.
+        state = dict(state)
+        if 'name' in state:
+            state.setdefault('title', state.pop('name'))
+        for x in self.__slots__:
+            setattr(self, x, state.get(x))
+
+    def _read_metadata_from_file(self, strings):
+        required_attrs = dict(title=None, track=None, disc=None, album=None,
+                              year=None, artist=None, genre=None, time=None,
+                              format=None, bitrate=None, size=None)
+        for key,val in required_attrs.iteritems():
+            setattr(self, key, val)
+
+        if Track.header_tags:
+            try:
+                tags = read_header_tags(self.filename)
+            except (EnvironmentError, struct.error):
+                tags = None
+            if tags is not None:
+                for key, val in tags.iteritems():
+                    setattr(self, key, val)
+                self.album = _intern(strings, self.album)
+                self.artist = _intern(strings, self.artist)
+                self.genre = _intern(strings, self.genre)
+                return
+
+        if not Track.filetypes:
+            _import_tagpy()
+            Track.filetypes.update({tagpy._tagpy.mpeg_File: 'mp3',
+                                    tagpy._tagpy.ogg_vorbis_File: 'ogg'})
+        try:
+            fileref = tagpy.FileRef(self.filename)
+        except Exception, e:
+            print "Could not read track metadata: ", e
+            return
+
+        tags = fileref.tag()
+        self.title = tags.title
+        self.album = _intern(strings, tags.album)
+        self.artist = _intern(strings, tags.artist)
+        self.genre = _intern(strings, tags.genre or None)
+        self.track = tags.track
+        self.year = tags.year
+        try:
+            self.size = os.path.getsize(self.filename)
+        except EnvironmentError:
+            pass
+        
+        audioProperties = fileref.audioProperties()
+        self.time = audioProperties.length
+        self.bitrate = audioProperties.bitrate
+
+        self.format = type(fileref.file())
+        if self.format in Track.filetypes:
+            self.format = Track.filetypes[self.format]
+
+    def __unicode__(self):
+        tn = ''
+        if self.track:
+            tn = '%s - ' % self.track
+        tm = ''
+        if self.time:
+            tm = ' [%0.2f]' % self.time
+        yr = ''
+        if self.year:
+            yr = ' (%s)' % self.year
+        return u'%s - %s%s - %s%s%s (%s)' % (self.artist, self.album, yr, tn,
+                                             self.name, tm, self.format)
+
+    def __str__(self):
+        return str(self.__unicode__().encode('utf-8', 'replace'))
+
+
+def _daap_track_key(track):
+    """ Return a string identifying the given DAAP track across
+    sessions, or None if it isn't one. """
+    try:
+        database = track.database
+        connection = database.session.connection
+    except AttributeError:
+        return None
+    if not track.size:
+        return None
+    return '%s_%d_%s_%s_%s.%s' % (connection.hostname, connection.port,
+                                  database.id, track.id, track.size,
+                                  track.type)
+
+
+class TrackCache(object):
+    """
+    Size-bounded local cache of tracks streamed from DAAP servers.
+
+    Tracks are keyed on (server, database id, item id, size).  The
+    first time a track is played it is streamed from the server as
+    usual, and once it has been played through (see played) a
+    background thread downloads a copy; after that the cached file is
+    played instead.  Downloading only then keeps the server from
+    sending the track twice at the same time.  Interrupted downloads
+    are resumed with HTTP Range requests.  The least recently played
+    tracks are evicted once the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, cachedir='~/.daap_player_cache', max_bytes=1 << 30,
+                 metrics=None):
+        self.cachedir = os.path.abspath(os.path.expanduser(cachedir))
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        # PlaybackMetrics to record download rates and errors in.
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        # filename -> size, least recently used first.  Partially
+        # downloaded tracks end in .part.  The cache directory is only
+        # read when the cache is first used, see __scan.
+        self.__entries = None
+        self.__total = 0
+        self.__queued = set()
+        self.__max_bytes = max_bytes
+        # Started along with the thread downloading the queued tracks.
+        self.__queue = None
+
+    def __str__(self):
+        self.__lock.acquire()
+        try:
+            return ('%d tracks, %0.1f/%0.1f MB, %d hits, %d misses (%s)'
+                    % (len(self.__scan()), self.__total / 1048576.0,
+                       self.max_bytes / 1048576.0, self.hits, self.misses,
+                       self.cachedir))
+        finally:
+            self.__lock.release()
+
+    def __scan(self):
+        """ Return the entries, reading the cache directory the first
+        time.  Must be called with the lock held. """
+        if self.__entries is not None:
+            return self.__entries
+        self.__entries = collections.OrderedDict()
+        paths = [os.path.join(self.cachedir, x)
+                 for x in os.listdir(self.cachedir)]
+        paths.sort(key=os.path.getmtime)
+        for path in paths:
+            self.__set_size(os.path.basename(path), os.path.getsize(path))
+        self.__evict(keep=())
+        return self.__entries
+
+    def key(self, track):
+        """ Return the cache filename of the given track, or None if
+        it can't be cached. """
+        return _daap_track_key(track)
+
+    def __get_max_bytes(self):
+        return self.__max_bytes
+
+    def __set_max_bytes(self, max_bytes):
+        self.__lock.acquire()
+        try:
+            self.__max_bytes = max_bytes
+            self.__scan()
+            keep = set(self.__queued)
+            keep.update([x + '.part' for x in self.__queued])
+            self.__evict(keep)
+        finally:
+            self.__lock.release()
+
+    max_bytes = property(__get_max_bytes, __set_max_bytes)
+
+    def uri(self, track):
+        """ Return the uri to play the given track from. """
+        name = self.key(track)
+        if name is None:
+            return track.uri
+        path = os.path.join(self.cachedir, name)
+        self.__lock.acquire()
+        try:
+            if name in self.__scan() and os.path.exists(path):
+                self.__set_size(name, self.__entries[name])
+                self.hits += 1
+                os.utime(path, None)
+                return 'file://%s' % urllib.quote(path)
+            self.misses += 1
+        finally:
+            self.__lock.release()
+        return track.uri
+
+    def played(self, track):
+        """ Start caching the given track, which has just been played
+        through, unless it is cached already. """
+        name = self.key(track)
+        if name is None:
+            return
+        self.__lock.acquire()
+        try:
+            if name not in self.__scan() and name not in self.__queued:
+                self.__queued.add(name)
+                if self.__queue is None:
+                    self.__queue = Queue.Queue()
+                    downloader = threading.Thread(
+                        target=self.__download_queued)
+                    downloader.setDaemon(True)
+                    downloader.start()
+                self.__queue.put((name, track))
+        finally:
+            self.__lock.release()
+
+    def fetching(self, track):
+        """ Return whether the given track is being downloaded. """
+        self.__lock.acquire()
+        try:
+            return self.key(track) in self.__queued
+        finally:
+            self.__lock.release()
+
+    def __set_size(self, name, size):
+        """ Record the size of the given file and mark it as the most
+        recently used.  Must be called with the lock held. """
+        self.__total -= self.__entries.pop(name, 0)
+        if size is not None:
+            self.__entries[name] = size
+            self.__total += size
+
+    def __evict(self, keep):
+        for name in self.__entries.keys():
+            if self.__total <= self.max_bytes:
+                break
+            if name in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                pass
+            self.__set_size(name, None)
+
+    def __download_queued(self):
+        while True:
+            name, track = self.__queue.get()
+            # Only now take the uri, which has the current DAAP session
+            # id in it.
+            uri = track.uri
+            try:
+                self.__download(name, uri, track.size)
+            except Exception, e:
+                # Not printed: in the daemon that would go to whichever
+                # client is running a command.
+                print >> sys.stderr, "Error caching %s: %s" % (uri, e)
+                if self.metrics:
+                    self.metrics.error(uri)
+            self.__lock.acquire()
+            self.__queued.discard(name)
+            self.__lock.release()
+
+    def __download(self, name, uri, size):
+        partname = name + '.part'
+        path = os.path.join(self.cachedir, partname)
+        have = 0
+        if os.path.exists(path):
+            have = os.path.getsize(path)
+        request = urllib2.Request(uri)
+        if have:
+            request.add_header('Range', 'bytes=%d-' % have)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if not have or e.code != 416:
+                raise
+            # The partial download was complete already.
+            self.__finish(name, path, have)
+            return
+        if have and response.getcode() != 206:
+            # The server ignored the Range header.
+            have = 0
+        f = open(path, have and 'ab' or 'wb')
+        nbytes = 0
+        started = time.time()
+        try:
+            data = response.read(64 * 1024)
+            while data:
+                f.write(data)
+                nbytes += len(data)
+                data = response.read(64 * 1024)
+        finally:
+            f.close()
+            response.close()
+            if self.metrics:
+                self.metrics.read(uri, nbytes, time.time() - started)
+            self.__finish(name, path, size)
+
+    def __finish(self, name, path, size):
+        """ Record how much of the track name has been downloaded to
+        path, and move it into place if that is all of it. """
+        partname = name + '.part'
+        self.__lock.acquire()
+        try:
+            self.__scan()
+            self.__set_size(partname, os.path.getsize(path))
+            if self.__entries[partname] >= size:
+                os.rename(path, os.path.join(self.cachedir, name))
+                self.__set_size(name, self.__entries[partname])
+                self.__set_size(partname, None)
+            self.__evict(keep=(name, partname))
+        finally:
+            self.__lock.release()
+
+
+# MPEG audio frame header fields, see
+# http://www.mp3-tech.org/programmer/frame_header.html
+_mp3_bitrates = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+             416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_mp3_bitrates[(2, 3)] = _mp3_bitrates[(2, 2)]
+_mp3_samplerates = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000],
+                    2.5: [11025, 12000, 8000]}
+
+
+def _mp3_frame(header):
+    """ Return (length, samples, samplerate, side info offset) of the
+    frame with the given 4 byte header, or None if it isn't one. """
+    h = struct.unpack('>I', header)[0]
+    if h >> 21 != 0x7ff:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((h >> 19) & 3)
+    layer = 4 - ((h >> 17) & 3)
+    bitrate = (h >> 12) & 15
+    samplerate = (h >> 10) & 3
+    if version is None or layer == 4 or bitrate in (0, 15) or samplerate == 3:
+        return None
+    bitrate = _mp3_bitrates[(min(version, 2), layer)][bitrate] * 1000
+    samplerate = _mp3_samplerates[version][samplerate]
+    padding = (h >> 9) & 1
+    if layer == 1:
+        length = (12 * bitrate / samplerate + padding) * 4
+        samples = 384
+    elif layer == 2 or version == 1:
+        length = 144 * bitrate / samplerate + padding
+        samples = 1152
+    else:
+        length = 72 * bitrate / samplerate + padding
+        samples = 576
+    mono = (h >> 6) & 3 == 3
+    side = {(True, False): 32, (True, True): 17,
+            (False, False): 17, (False, True): 9}[(version == 1, mono)]
+    if not (h >> 16) & 1:
+        # Followed by a CRC.
+        side += 2
+    return length, samples, samplerate, 4 + side
+
+
+def _id3v2_size(buf):
+    """ Return the size of the ID3v2 tag at the start of buf, or 0 if
+    there isn't one. """
+    if buf[:3] != 'ID3' or len(buf) < 10:
+        return 0
+    size = 10 + _syncsafe(buf[6:10])
+    if ord(buf[5]) & 0x10:
+        # Footer
+        size += 10
+    return size
+
+
+def _syncsafe(data):
+    size = 0
+    for x in data:
+        size = (size << 7) | (ord(x) & 0x7f)
+    return size
+
+
+def _mp3_first_frame(buf, start=0):
+    """ Return the offset and _mp3_frame of the first MP3 frame in buf
+    at or after start, or (None, None).  The first frame is where a
+    frame header is followed by another. """
+    pos = buf.find('\xff', start)
+    while 0 <= pos < len(buf) - 4:
+        frame = _mp3_frame(buf[pos:pos + 4])
+        if (frame and pos + frame[0] + 4 <= len(buf) and
+            _mp3_frame(buf[pos + frame[0]:pos + frame[0] + 4])):
+            return pos, frame
+        pos = buf.find('\xff', pos + 1)
+    return None, None
+
+
+class SeekIndex(object):
+    """
+    Byte offsets of points in time in an MP3 file, for seeking straight
+    to the right frame.
+    """
+    def __init__(self, times, offsets, duration):
+        self.times = array.array('d', times)
+        self.offsets = array.array('L', offsets)
+        self.duration = duration
+
+    def offset(self, time_sec):
+        """ Return the offset of the last indexed frame at or before
+        the given time. """
+        n = bisect.bisect_right(self.times, time_sec) - 1
+        return self.offsets[max(n, 0)]
+
+
+def read_seek_index(f, interval=1.0, blocksize=64 * 1024):
+    """ Read a SeekIndex for the MP3 stream in the file-like object f.
+
+    The index is taken from the Xing or VBRI header if there is one, so
+    only the start of the stream is read.  Otherwise every frame is
+    read through, noting the offset of one every interval seconds.
+    Return None if f doesn't look like an MP3 stream.
+    """
+    # buf holds the stream from offset base onwards.
+    buf = f.read(blocksize)
+    base = 0
+    start = _id3v2_size(buf)
+    if start:
+        while len(buf) < start + blocksize:
+            data = f.read(blocksize)
+            if not data:
+                break
+            buf += data
+    first, frame = _mp3_first_frame(buf, start)
+    if first is None:
+        return None
+    length, samples, samplerate, side = frame
+    frame_time = float(samples) / samplerate
+
+    tag = buf[first + side:first + side + 4]
+    if tag in ('Xing', 'Info'):
+        p = first + side + 4
+        flags = struct.unpack('>I', buf[p:p + 4])[0]
+        p += 4
+        frames = nbytes = toc = None
+        if flags & 1:
+            frames = struct.unpack('>I', buf[p:p + 4])[0]
+            p += 4
+        if flags & 2:
+            nbytes = struct.unpack('>I', buf[p:p + 4])[0]
+            p += 4
+        if flags & 4:
+            toc = [ord(x) for x in buf[p:p + 100]]
+        if frames and nbytes and toc:
+            duration = frames * frame_time
+            return SeekIndex([duration * x / 100.0 for x in xrange(100)],
+                             [first + nbytes * x / 256 for x in toc],
+                             duration)
+    elif buf[first + 36:first + 40] == 'VBRI':
+        (nbytes, frames, entries, scale, entry_size,
+         entry_frames) = struct.unpack('>IIHHHH', buf[first + 46:first + 62])
+        p = first + 62
+        fmt = {1: '>B', 2: '>H', 3: None, 4: '>I'}.get(entry_size)
+        if fmt and entries and len(buf) >= p + entries * entry_size:
+            times = [0.0]
+            offsets = [first]
+            for n in xrange(entries):
+                size = struct.unpack(fmt, buf[p:p + entry_size])[0]
+                p += entry_size
+                times.append((n + 1) * entry_frames * frame_time)
+                offsets.append(offsets[-1] + size * scale)
+            return SeekIndex(times, offsets, frames * frame_time)
+
+    # No usable header, go through all the frames.
+    times = []
+    offsets = []
+    t = 0.0
+    next_time = 0.0
+    pos = first
+    while True:
+        while pos - base + 4 > len(buf):
+            data = f.read(blocksize)
+            if not data:
+                break
+            # The last frame may have ended beyond what was read.
+            keep = min(pos, base + len(buf))
+            buf = buf[keep - base:] + data
+            base = keep
+        header = buf[pos - base:pos - base + 4]
+        if len(header) < 4:
+            break
+        frame = _mp3_frame(header)
+        if frame is None:
+            if header[:3] == 'TAG':
+                break
+            # Lost sync, look for the next frame.
+            pos += 1
+            continue
+        if t >= next_time:
+            times.append(t)
+            offsets.append(pos)
+            next_time += interval
+        length, samples, samplerate = frame[:3]
+        t += float(samples) / samplerate
+        pos += length
+    if not times:
+        return None
+    return SeekIndex(times, offsets, t)
+
+
+class SeekIndexes(object):
+    """
+    Seek indexes of the MP3 tracks played over HTTP.
+
+    An index is built in the background the first time a track is
+    seeked in, from the start of the stream when it has a Xing or VBRI
+    header or else by reading it through once, and is kept between
+    runs of the player.  The file they are kept in is only read once
+    they are first needed, and each new index is appended to it.
+    """
+    def __init__(self, filename='~/.daap_player_seek_indexes'):
+        self.filename = os.path.expanduser(filename)
+        self.__lock = threading.Lock()
+        # key -> SeekIndex, or None for tracks that can't be indexed,
+        # see __load.
+        self.__indexes = None
+        self.__queued = set()
+        # Started along with the thread building the queued indexes.
+        self.__queue = None
+
+    def __str__(self):
+        with self.__lock:
+            return '%d seek indexes (%s)' % (len(self.__load()),
+                                             self.filename)
+
+    def key(self, track):
+        return _daap_track_key(track) or track.uri
+
+    def get(self, track):
+        """ Return the SeekIndex of the given track, or None if it
+        hasn't got one (yet). """
+        key = self.key(track)
+        with self.__lock:
+            return self.__load().get(key)
+
+    def prepare(self, track, uri):
+        """ Start building an index for the given track, read from the
+        given uri, unless it already has one. """
+        if getattr(track, 'format', None) != 'mp3':
+            return
+        key = self.key(track)
+        with self.__lock:
+            if key in self.__load() or key in self.__queued:
+                return
+            self.__queued.add(key)
+            if self.__queue is None:
+                self.__queue = Queue.Queue()
+                builder = threading.Thread(target=self.__build_queued)
+                builder.setDaemon(True)
+                builder.start()
+        self.__queue.put((key, uri))
+
+    def __build_queued(self):
+        while True:
+            key, uri = self.__queue.get()
+            try:
+                f = urllib2.urlopen(uri)
+                try:
+                    index = read_seek_index(f)
+                finally:
+                    f.close()
+                with self.__lock:
+                    self.__indexes[key] = index
+                    self.__append(key, index)
+            except Exception, e:
+                # Not printed: in the daemon that would go to whichever
+                # client is running a command.
+                print >> sys.stderr, "Error indexing %s: %s" % (uri, e)
+            with self.__lock:
+                self.__queued.discard(key)
+
+    def __load(self):
+        """ Return the indexes, reading those kept by earlier runs the
+        first time.  Must be called with the lock held. """
+        if self.__indexes is not None:
+            return self.__indexes
+        self.__indexes = {}
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        break
+                    if isinstance(record, dict):
+                        # Older versions rewrote all of them at once.
+                        self.__indexes.update(record)
+                    else:
+                        key, index = record
+                        self.__indexes[key] = index
+            finally:
+                f.close()
+        except Exception:
+            # Whatever was read before a damaged record is kept.
+            pass
+        return self.__indexes
+
+    def __append(self, key, index):
+        """ Add an index to the file.  Must be called with the lock
+        held. """
+        f = open(self.filename, 'ab')
+        try:
+            pickle.dump((key, index), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+
+# Collection snapshots are a flat binary file that can be memory
+# mapped and used without unpickling anything.  All integers are
+# little endian.  The layout is:
+#
+#   header: magic, version, number of tracks, number of strings,
+#           offset of the string offsets, offset of the string data,
+#           number of columns
+#   columns: name, type, offset of the data, offset and size of the
+#            index (0 if there is none), one entry per column
+#   strings: (number of strings + 1) uint32 offsets into the
+#            string data, followed by the utf-8 encoded string data
+#   column data: one value per track, either a uint32 string id ('s'),
+#                an int32 ('i') or an int64 ('q')
+#   indexes (string columns only): the sorted ids of the distinct
+#            values in the column, uint32 offsets into the postings
+#            for each of them (plus one), and the postings: the track
+#            numbers having each value
+SNAPSHOT_MAGIC = 'DAAPSNAP'
+SNAPSHOT_VERSION = 1
+_snapshot_header = struct.Struct('<8sIIIQQI')
+_snapshot_column = struct.Struct('<16scQQI')
+_snapshot_types = {'s': 'I', 'i': 'i', 'q': 'q'}
+_snapshot_none = {'s': 0xffffffff, 'i': -2**31, 'q': -2**63}
+
+# (attribute, type, indexed) of each column.  time is stored in ms.
+track_columns = [('uri', 's', False),
+                 ('name', 's', True),
+                 ('artist', 's', True),
+                 ('album', 's', True),
+                 ('genre', 's', True),
+                 ('format', 's', True),
+                 ('year', 'i', False),
+                 ('track', 'i', False),
+                 ('disc', 'i', False),
+                 ('time', 'i', False),
+                 ('size', 'q', False),
+                 ('bitrate', 'i', False)]
+
+
+def _column_value(track, attr):
+    if isinstance(track, FederatedTrack):
+        # Its time is in whatever unit its current best source uses.
+        track = track.best()
+    if attr == 'uri':
+        # Stored tracks keep their uri without a session id; uri would
+        # find a session, maybe logging in, only for it to be dropped.
+        val = getattr(track, 'stored_uri', None)
+        if val is None:
+            val = getattr(track, 'uri', None)
+        # The session id is added back when the track is played.
+        return _daap_base_uri(val)
+    val = getattr(track, attr, None)
+    if attr == 'time' and val and not isinstance(track, daap.DAAPTrack):
+        # Everything but DAAPTrack measures time in seconds.
+        val = int(round(1000 * val))
+    elif attr == 'format' and val is not None:
+        val = unicode(val)
+    return val
+
+
+def write_snapshot(tracks, filename):
+    """ Save the given tracks to a collection snapshot file. """
+    # Every column has to cover the same tracks, even if a background
+    # load adds more in the meantime.
+    tracks = list(tracks)
+    ntracks = len(tracks)
+    strings = {}
+    columns = []
+    for attr, type_, indexed in track_columns:
+        none = _snapshot_none[type_]
+        values = []
+        for x in tracks:
+            val = _column_value(x, attr)
+            if val is None:
+                val = none
+            elif type_ == 's':
+                val = strings.setdefault(val, len(strings))
+            else:
+                val = int(val)
+            values.append(val)
+        columns.append((attr, type_, indexed, values))
+
+    string_data = [(x.encode('utf-8') if isinstance(x, unicode) else x)
+                   for x, id in sorted(strings.items(), key=lambda x: x[1])]
+    string_offsets = [0]
+    for x in string_data:
+        string_offsets.append(string_offsets[-1] + len(x))
+
+    chunks = []
+    pos = [_snapshot_header.size + len(columns) * _snapshot_column.size]
+    def add(data):
+        chunks.append(data)
+        start = pos[0]
+        pos[0] += len(data)
+        return start
+
+    offsets_pos = add(struct.pack('<%dI' % len(string_offsets),
+                                  *string_offsets))
+    strings_pos = add(''.join(string_data))
+    directory = []
+    for attr, type_, indexed, values in columns:
+        data_pos = add(struct.pack('<%d%s' % (ntracks, _snapshot_types[type_]),
+                                   *values))
+        index_pos = index_len = 0
+        if indexed:
+            postings = {}
+            for n, val in enumerate(values):
+                postings.setdefault(val, []).append(n)
+            ids = sorted(postings)
+            starts = [0]
+            rows = []
+            for val in ids:
+                rows.extend(postings[val])
+                starts.append(len(rows))
+            index_len = len(ids)
+            index_pos = add(struct.pack('<%dI' % index_len, *ids) +
+                            struct.pack('<%dI' % (index_len + 1), *starts) +
+                            struct.pack('<%dI' % ntracks, *rows))
+        directory.append(_snapshot_column.pack(attr, type_, data_pos,
+                                               index_pos, index_len))
+
+    tmpfile = filename + '.tmp'
+    f = open(tmpfile, 'wb')
+    try:
+        f.write(_snapshot_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                      ntracks, len(string_data), offsets_pos,
+                                      strings_pos, len(columns)))
+        f.write(''.join(directory))
+        for x in chunks:
+            f.write(x)
+    finally:
+        f.close()
+    os.rename(tmpfile, filename)
+
+
+class CollectionSnapshot(object):
+    """
+    Memory mapped collection snapshot.  Nothing is read from the file
+    until it is needed, so opening even a huge snapshot is instant and
+    memory use only grows with the tracks that are actually used.
+    """
+
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            self.__data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, version, self.ntracks, self.nstrings, self.__offsets_pos,
+         self.__strings_pos, ncolumns) = _snapshot_header.unpack_from(
+             self.__data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a collection snapshot' % filename)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('%s: unsupported snapshot version %d'
+                             % (filename, version))
+        self.columns = {}
+        for n in range(ncolumns):
+            name, type_, data_pos, index_pos, index_len = (
+                _snapshot_column.unpack_from(
+                    self.__data, _snapshot_header.size
+                    + n * _snapshot_column.size))
+            self.columns[name.rstrip('\0')] = (type_, data_pos, index_pos,
+                                               index_len)
+        self.__strings = {}
+        self.__string_offsets = None
+        self.__indexes = {}
+
+    def string(self, id):
+        try:
+            return self.__strings[id]
+        except KeyError:
+            start, end = struct.unpack_from('<2I', self.__data,
+                                            self.__offsets_pos + 4 * id)
+            string = self.__data[self.__strings_pos + start:
+                                 self.__strings_pos + end].decode('utf-8')
+            self.__strings[id] = string
+            return string
+
+    def __decode(self, type_, val):
+        if val == _snapshot_none[type_]:
+            return None
+        elif type_ == 's':
+            return self.string(val)
+        return val
+
+    def value(self, column, track):
+        """ Return the value of the given column for the given track. """
+        type_, data_pos, index_pos, index_len = self.columns[column]
+        size = type_ == 'q' and 8 or 4
+        val = struct.unpack_from('<' + _snapshot_types[type_], self.__data,
+                                 data_pos + size * track)[0]
+        return self.__decode(type_, val)
+
+    def values(self, column):
+        """ Return the values of the given column for all tracks. """
+        type_, data_pos, index_pos, index_len = self.columns[column]
+        vals = struct.unpack_from('<%d%s' % (self.ntracks,
+                                             _snapshot_types[type_]),
+                                  self.__data, data_pos)
+        return [self.__decode(type_, x) for x in vals]
+
+    def array(self, column):
+        """ Return the raw values of the given column for all tracks as
+        a read-only NumPy array: string ids for string columns, and
+        _snapshot_none for missing values. """
+        type_, data_pos, index_pos, index_len = self.columns[column]
+        return _import_numpy().frombuffer(
+            self.__data, '<' + _snapshot_types[type_], self.ntracks, data_pos)
+
+    def is_indexed(self, column):
+        return column in self.columns and self.columns[column][2] != 0
+
+    def search(self, column, pattern):
+        """ Return the numbers of the tracks whose value in the given
+        (indexed) column matches the given compiled regexp. """
+        type_, data_pos, index_pos, index_len = self.columns[column]
+        if column not in self.__indexes:
+            ids = struct.unpack_from('<%dI' % index_len, self.__data,
+                                     index_pos)
+            starts = struct.unpack_from('<%dI' % (index_len + 1),
+                                        self.__data, index_pos + 4 * index_len)
+            self.__indexes[column] = (ids, starts)
+        ids, starts = self.__indexes[column]
+        postings_pos = index_pos + 4 * (2 * index_len + 1)
+        # Read all the strings directly rather than through the
+        # string cache, which would otherwise end up holding every
+        # value in the column.
+        if self.__string_offsets is None:
+            self.__string_offsets = struct.unpack_from(
+                '<%dI' % (self.nstrings + 1), self.__data, self.__offsets_pos)
+        offsets = self.__string_offsets
+        base = self.__strings_pos
+        tracks = []
+        for n, id in enumerate(ids):
+            if id == _snapshot_none['s']:
+                continue
+            val = self.__data[base + offsets[id]:
+                              base + offsets[id + 1]].decode('utf-8')
+            if val and pattern.search(val):
+                start, end = starts[n], starts[n + 1]
+                tracks.extend(struct.unpack_from('<%dI' % (end - start),
+                                                 self.__data,
+                                                 postings_pos + 4 * start))
+        return tracks
+
+
+class SnapshotTrack(object):
+    """ A track in a CollectionSnapshot, read from it on demand. """
+    __slots__ = ('snapshot', 'index')
+
+    def __init__(self, snapshot, index):
+        self.snapshot = snapshot
+        self.index = index
+
+    def __getattr__(self, name):
+        column = name
+        if name == 'stored_uri':
+            # As saved, without a session id.
+            column = 'uri'
+        if column not in self.snapshot.columns:
+            raise AttributeError, name
+        val = self.snapshot.value(column, self.index)
+        if name == 'time' and val is not None:
+            val = 1e-3 * val
+        elif name == 'uri':
+            val = _daap_live_uri(val)
+        return val
+
+    def __eq__(self, other):
+        return (isinstance(other, SnapshotTrack)
+                and self.snapshot is other.snapshot
+                and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.snapshot), self.index))
+
+    __unicode__ = Track.__unicode__.im_func
+    __str__ = Track.__str__.im_func
+
+
+class SnapshotTracks(object):
+    """ Read-only sequence of the SnapshotTracks in a snapshot. """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.ntracks
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('track index out of range')
+        return SnapshotTrack(self.snapshot, index)
+
+    def __iter__(self):
+        for n in xrange(len(self)):
+            yield SnapshotTrack(self.snapshot, n)
+
+
+class SnapshotCollection(BaseCollection):
+    """Music collection saved to a snapshot file by write_snapshot."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.snapshot = CollectionSnapshot(filename)
+        self.tracks = SnapshotTracks(self.snapshot)
+
+    def _search(self, pattern, fields, flags):
+        pat = re.compile(pattern, flags)
+        matches = set()
+        for y in fields:
+            if self.snapshot.is_indexed(y):
+                matches.update(self.snapshot.search(y, pat))
+            elif y in self.snapshot.columns:
+                matches.update([n for n, x in
+                                enumerate(self.snapshot.values(y))
+                                if x and pat.search(unicode(x))])
+            else:
+                raise AttributeError, y
+        return Playlist([self.tracks[x] for x in sorted(matches)])
+
+
+class SqliteTrack(object):
+    """ A track read from SqliteTracks. """
+    columns = ('rowid',) + tuple([x[0] for x in track_columns])
+    # The stored uri is kept as stored_uri, see uri.
+    __slots__ = tuple([x == 'uri' and 'stored_uri' or x for x in columns])
+
+    def __init__(self, row):
+        for attr, val in zip(self.__slots__, row):
+            setattr(self, attr, val)
+        if self.time is not None:
+            self.time *= 1e-3
+
+    def __get_uri(self):
+        return _daap_live_uri(self.stored_uri)
+
+    uri = property(__get_uri)
+
+    def __eq__(self, other):
+        return isinstance(other, SqliteTrack) and self.rowid == other.rowid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.rowid)
+
+    __unicode__ = Track.__unicode__.im_func
+    __str__ = Track.__str__.im_func
+
+
+class SqliteTracks(object):
+    """
+    Sequence of tracks stored in a sqlite database instead of memory,
+    for collections that are too big to fit in RAM.  Tracks are
+    returned in the same order BaseCollection.sort_tracks would put
+    them in, and searches run as SQL queries.
+
+    Each thread gets its own connection, so tracks can be loaded in
+    the background while the collection is being searched.
+    """
+    order = 'artist, year, album, disc, track, uri'
+
+    def __init__(self, filename, clear=False):
+        self.filename = os.path.abspath(os.path.expanduser(filename))
+        self.__local = threading.local()
+        self.__columns = ', '.join([x[0] for x in track_columns])
+        db = self.__db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS tracks (%s)' % ', '.join(
+            ['%s %s' % (x[0], x[1] == 's' and 'TEXT' or 'INTEGER')
+             for x in track_columns]))
+        db.execute('CREATE INDEX IF NOT EXISTS tracks_order ON tracks (%s)'
+                   % self.order)
+        for x in ['album', 'genre', 'year']:
+            db.execute('CREATE INDEX IF NOT EXISTS tracks_%s ON tracks (%s)'
+                       % (x, x))
+        db.commit()
+        if clear:
+            self.clear()
+        self.__len = db.execute('SELECT count(*) FROM tracks').fetchone()[0]
+        # (number of tracks, array of their rowids in order), see
+        # __getitem__
+        self.__rowids = (None, None)
+
+    def __getstate__(self):
+        # Connections can't be pickled, they are reopened as needed,
+        # and so is the track order.
+        state = self.__dict__.copy()
+        del state['_SqliteTracks__local']
+        del state['_SqliteTracks__rowids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__local = threading.local()
+        self.__rowids = (None, None)
 
-    def ff(self, time=10):
-        """ Fast forward """
-        self.position += time
+    def __db(self):
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = self.__local.db = sqlite3.connect(self.filename)
+        return db
 
-    def rew(self, time=10):
-        """ Rewind """
-        self.position -= time
+    def __select(self, where='', args=(), limit=''):
+        return self.__db().execute(
+            'SELECT rowid, %s FROM tracks %s ORDER BY %s %s'
+            % (self.__columns, where, self.order, limit), args)
 
-    def __get_duration(self):
-        try:
-            dur = 1e-9 * self.__player.query_duration(
-                gst.Format(gst.FORMAT_TIME), None)[0]
-        except gst.QueryError:
-            dur = None
-        return dur
+    def clear(self):
+        db = self.__db()
+        db.execute('DELETE FROM tracks')
+        db.commit()
+        self.__len = 0
 
-    duration = property(__get_duration)
+    def extend(self, tracks):
+        db = self.__db()
+        db.executemany(
+            'INSERT INTO tracks (%s) VALUES (%s)'
+            % (self.__columns, ', '.join(['?'] * len(track_columns))),
+            [[_column_value(x, attr) for attr, type_, indexed in track_columns]
+             for x in tracks])
+        db.commit()
+        self.__len += len(tracks)
 
+    def __len__(self):
+        return self.__len
 
-class Playlist(list):
-    def shuffle(self):
-        random.shuffle(self)
+    def __iter__(self):
+        cursor = self.__select()
+        rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                yield SqliteTrack(row)
+            rows = cursor.fetchmany(1000)
 
-    def shuffle_albums(self):
-        albums = {}
-        for x in self:
-            albums.setdefault(x.album, []).append(x)
-        keys = albums.keys()
-        random.shuffle(keys)
-        self.clear()
-        for k in keys:
-            self.extend(albums[k])
-        
-    def clear(self):
-        self.__delslice__(0, len(self))
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            tracks = [SqliteTrack(x) for x in self.__select(
+                limit='LIMIT %d OFFSET %d' % (max(stop - start, 0), start))]
+            return tracks[::step]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('track index out of range')
+        # OFFSET would step through all the rows before index.
+        rowid = self.__rowid_order()[index]
+        row = self.__db().execute(
+            'SELECT rowid, %s FROM tracks WHERE rowid = ?' % self.__columns,
+            (rowid,)).fetchone()
+        return SqliteTrack(row)
+
+    def __rowid_order(self):
+        """ Return the rowids of the tracks in order, read once for
+        each number of tracks. """
+        count, rowids = self.__rowids
+        if count != self.__len:
+            count = self.__len
+            rowids = array.array('l', [x[0] for x in self.__db().execute(
+                'SELECT rowid FROM tracks ORDER BY %s' % self.order)])
+            self.__rowids = (count, rowids)
+        return rowids
 
     def search(self, pattern, fields=("artist", "album", "name"),
                flags=re.IGNORECASE):
         """ Return all tracks matching the given pattern. """
+        columns = [x[0] for x in track_columns]
+        for y in fields:
+            if y not in columns:
+                raise AttributeError, y
         pat = re.compile(pattern, flags)
-        tracknums = []
-        for n,x in enumerate(self):
-            for y in fields:
-                if getattr(x, y) and pat.search(getattr(x, y)):
-                    tracknums.append(n)
-                    break
-        return tracknums
+        def matches(val):
+            return val is not None and pat.search(unicode(val)) is not None
+        db = self.__db()
+        db.create_function('matches', 1, matches)
+        where = 'WHERE %s' % ' OR '.join(['matches(%s)' % y for y in fields])
+        return Playlist([SqliteTrack(x) for x in self.__select(where)])
 
-    def __str__(self):
-        return '\n'.join(['%d: %s' % (n+1, x) for n,x in enumerate(self)])
 
+class SqliteCollection(BaseCollection):
+    """Music collection previously stored in a sqlite database by
+    DaapCollection or DirectoryCollection."""
+    def __init__(self, dbfile):
+        self.tracks = SqliteTracks(dbfile)
 
-class BaseCollection(object):
-    """Base representation of a music collection."""
-    def init(self):
-        # Make sure tracks are sorted in some reasonable order.
-        for x in ['uri', 'track', 'disc', 'album', 'year', 'artist']:
-            self.tracks.sort(key=operator.attrgetter(x))
-    
-    def search(self, pattern, fields=("artist", "album", "name"),
-               flags=re.IGNORECASE):
-        """ Return all tracks matching the given pattern. """
-        pat = re.compile(pattern, flags)
-        tracks = Playlist()
-        for x in self.tracks:
-            for y in fields:
-                if getattr(x, y) and pat.search(getattr(x, y)):
-                    tracks.append(x)
-                    break
-        return tracks
 
+class FederatedTrack(object):
+    """
+    A track available from one or more of the sources of a
+    FederatedCollection.  Attributes, including the uri, come from
+    whichever source is currently the fastest.
+    """
+    __slots__ = ('collection', 'alternatives')
 
-class DaapCollection(BaseCollection):
-    """Music collection contained on a DAAP server."""
-    def __init__(self, server='localhost', port=3689, password=None):
-        self.__session = None
-        client = daap.DAAPClient();
-        client.connect(server, port=port, password=password)
-        self.__session = client.login()
-        self.tracks = self.__session.library().tracks()
+    def __init__(self, collection, source, track):
+        self.collection = collection
+        # (source, track) pairs
+        self.alternatives = [(source, track)]
 
-        self.init()
- 
-    def __del__(self):
-        if self.__session:
-            self.__session.logout()        
+    def best(self):
+        """ Return the copy of the track from the fastest source. """
+        return min(self.alternatives,
+                   key=lambda x: self.collection.source_latency(x[0]))[1]
 
+    def __getattr__(self, name):
+        return getattr(self.best(), name)
 
-class DirectoryCollection(BaseCollection):
-    """Music collection contained on the filesystem."""
-    def __init__(self, basedir, extensions=['mp3', 'ogg', 'flac', 'wav']):
-        basedir = os.path.abspath(os.path.expanduser(basedir))
-        extensions = [x.lower() for x in extensions]
-        tracks = []
-        for path, dirs, files in os.walk(basedir):
-            tracks.extend([Track(os.path.join(path, x)) for x in files
-                           if os.path.splitext(x)[-1][1:].lower() in extensions])
-        self.tracks = tracks
+    def __unicode__(self):
+        return unicode(self.best())
 
-        self.init()
+    def __str__(self):
+        return str(self.best())
 
 
-class Track(object):
-    filetypes = {tagpy._tagpy.mpeg_File: 'mp3',
-                 tagpy._tagpy.ogg_vorbis_File: 'ogg',
-                 }
+class FederatedCollection(BaseCollection):
+    """
+    Merged view of several DAAP servers and directories.
 
-    def __init__(self, filename):
-        self.uri = 'file://%s' % urllib.quote(filename)
-        self.filename = filename
-        self.name = os.path.basename(filename)
+    The sources are loaded in parallel, so loading takes about as long
+    as the slowest of them.  Tracks found in more than one source
+    (same artist, album, title, disc and track number) appear once and
+    are played from the source with the quickest login round trip;
+    directories are always preferred over servers.  Tracks without an
+    artist and title tag are never merged, and neither are tracks from
+    the same source.
 
-        print "Loading %s" % filename
-        self._read_metadata_from_file()
+    Each source is given as ('daap', server, port, password) or
+    ('dir', basedir).
+    """
+    def __init__(self, sources, background=False):
+        self.sources = []
+        self.errors = []
+        self.load(self.__load_sources(sources), background)
 
-    def _read_metadata_from_file(self):
-        required_attrs = dict(track=None, disc=None, album=None, year=None,
-                              artist=None, time=None, format=None)
-        for key,val in required_attrs.iteritems():
-            setattr(self, key, val)
+    def source_latency(self, source):
+        return getattr(source, 'login_time', 0.0)
 
+    def __open_source(self, spec, results):
         try:
-            fileref = tagpy.FileRef(self.filename)
+            if spec[0] == 'daap':
+                source = DaapCollection(*spec[1:])
+            elif spec[0] == 'dir':
+                source = DirectoryCollection(spec[1], verbose=False)
+            else:
+                raise ValueError('unknown source type %s' % spec[0])
+            results.put((spec, source, None))
         except Exception, e:
-            print "Could not read track metadata: ", e
-            return
+            results.put((spec, None, e))
 
-        tags = fileref.tag()
-        tagmap = dict(name='title', album='album',
-                      artist='artist', track='track', year='year')
-        for key, val in tagmap.iteritems():
-            setattr(self, key, getattr(tags, val))
-        
-        audioProperties = fileref.audioProperties()
-        self.time = audioProperties.length
+    def __track_key(self, track):
+        """ Return what identifies the given track across sources, or
+        None if it isn't tagged well enough to tell. """
+        key = []
+        for x in ['artist', 'title', 'album', 'disc', 'track']:
+            val = getattr(track, x, None)
+            if isinstance(val, basestring):
+                val = val.strip().lower()
+            key.append(val or None)
+        if key[0] is None or key[1] is None:
+            return None
+        return tuple(key)
 
-        self.format = type(fileref.file())
-        if self.format in Track.filetypes:
-            self.format = Track.filetypes[self.format]
+    def __load_sources(self, sources):
+        results = Queue.Queue()
+        for spec in sources:
+            opener = threading.Thread(target=self.__open_source,
+                                      args=(spec, results))
+            opener.setDaemon(True)
+            opener.start()
+        # Merge each source as soon as it has loaded.
+        merged = {}
+        for n in range(len(sources)):
+            spec, source, error = results.get()
+            if error:
+                self.errors.append((spec, error))
+                continue
+            self.sources.append(source)
+            batch = []
+            for x in source.tracks:
+                key = self.__track_key(x)
+                track = merged.get(key)
+                if track is not None and not [
+                    y for y, t in track.alternatives if y is source]:
+                    track.alternatives.append((source, x))
+                    continue
+                track = FederatedTrack(self, source, x)
+                if key is not None:
+                    merged.setdefault(key, track)
+                batch.append(track)
+            yield batch
 
-    def __unicode__(self):
-        tn = ''
-        if self.track:
-            tn = '%s - ' % self.track
-        tm = ''
-        if self.time:
-            tm = ' [%0.2f]' % self.time
-        yr = ''
-        if self.year:
-            yr = ' (%s)' % self.year
-        return u'%s - %s%s - %s%s%s (%s)' % (self.artist, self.album, yr, tn,
-                                             self.name, tm, self.format)
+    def __get_progress(self):
+        """ Return a string describing how far loading has got. """
+        progress = BaseCollection.progress.fget(self)
+        duplicates = (sum([len(x.tracks) for x in self.sources])
+                      - len(self.tracks))
+        progress += ' from %d sources (%d duplicates)' % (len(self.sources),
+                                                          duplicates)
+        for spec, error in self.errors:
+            progress += '\nFailed to load %s: %s' % (' '.join(
+                [str(x) for x in spec[:3]]), error)
+        return progress
+
+    progress = property(__get_progress)
 
-    def __str__(self):
-        return str(self.__unicode__().encode('utf-8', 'replace'))
 
+class CollectionStats(object):
+    """
+    The numeric and categorical columns of a collection in NumPy
+    arrays, so that aggregate queries don't have to look at every track
+    again.
+
+    Numeric columns hold NaN for missing values, and time is in
+    seconds.  Categorical columns are held as codes into the list of
+    their distinct values.
+    """
+    numeric_fields = ('time', 'size', 'year', 'track', 'disc', 'bitrate')
+    categorical_fields = ('genre', 'artist', 'album', 'format')
+    # Numeric fields grouped into buckets, and how to show them.
+    buckets = {'time': (60, '%d min'), 'size': (1 << 20, '%d MB')}
+
+    def __init__(self, tracks):
+        _import_numpy()
+        self.numeric = {}
+        self.codes = {}
+        self.labels = {}
+        if isinstance(tracks, SnapshotTracks):
+            self.__read_snapshot(tracks.snapshot)
+        else:
+            self.__read_tracks(tracks)
+        self.numeric['time'] /= 1000.0
+        self.count = len(self.numeric['time'])
+
+    def __read_tracks(self, tracks):
+        numeric = dict([(x, []) for x in self.numeric_fields])
+        codes = dict([(x, []) for x in self.categorical_fields])
+        lookup = dict([(x, {}) for x in self.categorical_fields])
+        for track in tracks:
+            for x in self.numeric_fields:
+                numeric[x].append(_column_value(track, x))
+            for x in self.categorical_fields:
+                val = getattr(track, x, None)
+                if val not in lookup[x]:
+                    lookup[x][val] = len(lookup[x])
+                codes[x].append(lookup[x][val])
+        for x in self.numeric_fields:
+            # None becomes NaN.
+            self.numeric[x] = numpy.array(numeric[x], float)
+        for x in self.categorical_fields:
+            self.codes[x] = numpy.array(codes[x], numpy.int32)
+            labels = [None] * len(lookup[x])
+            for val, code in lookup[x].iteritems():
+                labels[code] = val
+            self.labels[x] = labels
+
+    def __read_snapshot(self, snapshot):
+        # Straight from the memory mapped columns, without creating a
+        # single track.
+        for x in self.numeric_fields:
+            if x not in snapshot.columns:
+                self.numeric[x] = numpy.empty(snapshot.ntracks)
+                self.numeric[x].fill(numpy.nan)
+                continue
+            raw = snapshot.array(x)
+            col = raw.astype(float)
+            col[raw == _snapshot_none[snapshot.columns[x][0]]] = numpy.nan
+            self.numeric[x] = col
+        for x in self.categorical_fields:
+            ids, codes = numpy.unique(snapshot.array(x), return_inverse=True)
+            self.codes[x] = codes
+            self.labels[x] = [id != _snapshot_none['s'] and
+                              snapshot.string(int(id)) or None for id in ids]
 
-def print_to_pager(string):
-    string = str(string)
-    if len(string.splitlines()) > 20:
-        pydoc.getpager()(string)
+    def total(self, field):
+        """ Return the sum of the given numeric field. """
+        return numpy.nansum(self.numeric[field])
+
+    def distinct(self, field):
+        """ Return the number of distinct values of the given
+        categorical field. """
+        return len([x for x in self.labels[field] if x is not None])
+
+    def group(self, field, order=None, limit=None):
+        """ Return (value, tracks, seconds, bytes) for each value of the
+        given field.  They are sorted by value for numeric fields, by
+        number of tracks for categorical ones, or in descending order of
+        the given column ('tracks', 'time' or 'size'). """
+        if field in self.categorical_fields:
+            codes = self.codes[field]
+            labels = self.labels[field]
+            if order is None:
+                order = 'tracks'
+        elif field in self.numeric_fields:
+            col = self.numeric[field]
+            bucket, fmt = self.buckets.get(field, (1, '%d'))
+            missing = numpy.isnan(col)
+            values = numpy.floor(numpy.where(missing, 0, col) / bucket)
+            # Unlike NaN, infinity is equal to itself, so all missing
+            # values end up in one group, sorted last.
+            values[missing] = numpy.inf
+            values, codes = numpy.unique(values, return_inverse=True)
+            labels = [not numpy.isinf(x) and fmt % x or None for x in values]
+        else:
+            raise AttributeError, field
+        tracks = numpy.bincount(codes, minlength=len(labels))
+        seconds = numpy.bincount(codes, numpy.nan_to_num(self.numeric['time']),
+                                 len(labels))
+        nbytes = numpy.bincount(codes, numpy.nan_to_num(self.numeric['size']),
+                                len(labels))
+        if order is None:
+            indexes = numpy.arange(len(labels))
+        else:
+            column = {'tracks': tracks, 'time': seconds,
+                      'size': nbytes}[order]
+            indexes = numpy.argsort(-column, kind='mergesort')
+        if limit is not None:
+            indexes = indexes[:limit]
+        return [(labels[n], int(tracks[n]), seconds[n], nbytes[n])
+                for n in indexes]
+
+
+def print_to_pager(text, max_lines=20):
+    """ Print text, through a pager if it is longer than max_lines.
+
+    text can also be anything with a lines() method, like a Playlist,
+    or any other iterable of lines.  These are rendered one line at a
+    time as the pager reads them, so the first page shows up straight
+    away and quitting the pager stops the rendering.
+    """
+    if hasattr(text, 'lines'):
+        lines = text.lines()
+    elif isinstance(text, basestring) or not hasattr(text, '__iter__'):
+        lines = iter(str(text).splitlines())
     else:
-        print string
+        lines = iter(text)
+    head = list(itertools.islice(lines, max_lines + 1))
+    if len(head) <= max_lines or not sys.stdout.isatty():
+        for line in itertools.chain(head, lines):
+            print line
+        return
+
+    command = _pipe_pager()
+    if command is None:
+        # Whatever pydoc falls back to, e.g. plain output on dumb
+        # terminals.
+        pydoc.getpager()('\n'.join(
+            [str(x) for x in itertools.chain(head, lines)]))
+        return
+    pager = None
+    try:
+        pager = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        # The first page fits in the pipe, so the writes succeed even
+        # if the shell couldn't find or run the pager.  Give it a moment
+        # to fail before streaming the rest, so that only the first page
+        # has to be kept for printing instead.
+        pager.stdin.write(''.join(['%s\n' % x for x in head]))
+        for n in xrange(20):
+            if pager.poll() is not None:
+                break
+            time.sleep(0.01)
+        if pager.returncode not in (126, 127):
+            head = []
+            for line in lines:
+                pager.stdin.write('%s\n' % line)
+        pager.stdin.close()
+    except (IOError, OSError):
+        # The pager was closed before reading everything, or couldn't
+        # be started.
+        pass
+    if pager is None or pager.wait() in (126, 127):
+        # The shell couldn't find or run the pager.
+        for line in itertools.chain(head, lines):
+            print line
+
+
+def _pipe_pager():
+    """ Return the command of the pager pydoc.getpager would pipe
+    text through, or None if it wouldn't use one. """
+    if not sys.stdin.isatty() or not sys.stdout.isatty():
+        return None
+    if 'PAGER' in os.environ:
+        return os.environ['PAGER']
+    if os.environ.get('TERM') in ('dumb', 'emacs'):
+        return None
+    for command in ('less', 'more'):
+        for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            if os.access(os.path.join(path, command), os.X_OK):
+                return command
+    return None
 
 
 class PlayerShell(cmd.Cmd):
@@ -397,6 +3601,16 @@ class PlayerShell(cmd.Cmd):
                        'pr': 'prev',
                        'pl': 'playlist',
                        'sa': 'shuffle_albums'}
+    commands_generated = False
+
+    # Collections are loaded in the background unless this is False,
+    # which profile and memtrace use to measure the whole load.
+    background_loads = True
+    # (collection, generation, CollectionStats) for the stats command.
+    __stats = None
+    # Whether the last command failed, for the exit status of -c.  Set
+    # back to False by precmd.
+    failed = False
 
     def __del__(self):
         del self.collection
@@ -405,62 +3619,79 @@ class PlayerShell(cmd.Cmd):
     def preloop(self):
         self.prompt = "DaapPlayer> "
         self.collection = None
-        self.player = Player()
+        metrics = PlaybackMetrics()
+        try:
+            cache = TrackCache(metrics=metrics)
+        except OSError, e:
+            print "Not caching tracks:", e
+            cache = None
+        self.player = Player(cache, SeekIndexes(), metrics)
 
         if os.path.exists(self.history_file):
             readline.read_history_file(self.history_file)
 
-        # Import functions from self.player and self.playlist that
-        # don't take any arguments.
+        self.__class__.generate_commands()
+
+    @classmethod
+    def generate_commands(cls):
+        """ Add commands for the Player and Playlist methods and
+        properties that don't take any arguments.  This is only done
+        once, the commands are kept in the class. """
+        if cls.commands_generated:
+            return
+        cls.commands_generated = True
+
         methods = [(k,v,'player') for k,v in Player.__dict__.items()]
         methods.extend([(k,v,'playlist') for k,v in Playlist.__dict__.items()])
-        for key,val,cls in methods:
+        for key,val,owner in methods:
             do_key = 'do_%s' % key
-            if key.startswith('_') or do_key in self.__class__.__dict__:
+            if key.startswith('_') or do_key in cls.__dict__:
                 continue
             elif type(val) is types.FunctionType:
                 (args, varargs, varkw, defaults) = inspect.getargspec(val)
                 ndefaults = len(defaults) if defaults else 0
                 if len(args) - ndefaults == 1:
-                    def do_fun(obj, rest, fun=val, cls=cls):
-                        if cls == 'player':
+                    def do_fun(obj, rest, fun=val, owner=owner):
+                        if owner == 'player':
                             fun(obj.player)
-                        elif cls == 'playlist':
+                        elif owner == 'playlist':
                             fun(obj.player.playlist)
                     do_fun.__doc__ = val.__doc__
-                    self.__class__.__dict__[do_key] = do_fun
+                    cls.__dict__[do_key] = do_fun
             elif type(val) is property:
-                def do_property(obj, rest, prop=key, cls=cls):
+                def do_property(obj, rest, prop=key, owner=owner):
                     if not rest:
-                        if cls == 'player':
+                        if owner == 'player':
                             val = obj.player.__getattribute__(prop)
-                        elif cls == 'playlist':
+                        elif owner == 'playlist':
                             val = obj.player.playlist.__getattribute__(prop)
                         print_to_pager(val)
                     else:
-                        if cls == 'player':
+                        if owner == 'player':
                             obj.player.__setattr__(prop, rest)
-                        elif cls == 'playlist ':
+                        elif owner == 'playlist ':
                             obj.player.playlist.__setattr__(prop, rest)
                 do_property.__doc__ = val.__doc__
-                self.__class__.__dict__[do_key] = do_property
+                cls.__dict__[do_key] = do_property
 
         # Set up aliases.
-        class_dict =  self.__class__.__dict__
+        class_dict = cls.__dict__
         for k,v in PlayerShell.command_aliases.items():
             if not k in class_dict:
                 class_dict['do_%s' % k] = class_dict['do_%s' % v]
 
+        cls.command_trie = PrefixTrie([x[3:] for x in dir(cls)
+                                       if x.startswith('do_')])
+
     def precmd(self, s):
+        self.failed = False
         if s:
             verb = s.split()[0]
-            do_verb = 'do_%s' % verb
-            matches = [x.replace('do_', '') for x in self.__class__.__dict__
-                       if do_verb in x]
+            matches = self.command_trie.complete(verb)
             if len(matches) == 1 and verb != matches[0]:
-                s = s.replace(verb, matches[0])
-            elif len(matches) > 1 and verb not in matches:
-                print 'Command "%s" is ambiguous, options are:' % verb
+                s = s.replace(verb, matches[0], 1)
+            elif len(matches) > 1 and verb not in self.command_trie:
+                self.error('Command "%s" is ambiguous, options are:' % verb)
                 for x in matches:
                     print x
         return s
@@ -469,7 +3700,18 @@ class PlayerShell(cmd.Cmd):
         try:
             cmd.Cmd.onecmd(self, s)
         except KeyboardInterrupt:
-            print 'Type "exit" to quit.'
+            self.error('Type "exit" to quit.')
+
+    def default(self, line):
+        self.failed = True
+        cmd.Cmd.default(self, line)
+
+    def error(self, *args):
+        """ Print args like the print statement would, and note that the
+        command being run failed (see failed). """
+        self.failed = True
+        print ' '.join([isinstance(x, basestring) and x or str(x)
+                        for x in args])
 
     def emptyline(self):
         pass
@@ -481,8 +3723,129 @@ class PlayerShell(cmd.Cmd):
         self.do_exit(rest)
 
     def do_exit(self, rest):
+        self.player.quit()
+        _close_daap_sessions()
         sys.exit(0)
 
+    def __parse_meta_options(self, rest, options):
+        """ Split the leading -x value options (with defaults given in
+        options) off rest, returning them and the rest of the line. """
+        options = dict(options)
+        args = rest.split()
+        while len(args) > 1 and args[0] in options:
+            options[args[0]] = type(options[args[0]] or '')(args[1])
+            del args[:2]
+        return options, self.precmd(' '.join(args))
+
+    def __run_in_foreground(self, line):
+        """ Run the given command line, loading any collection in the
+        foreground so that the whole load is measured. """
+        background_loads = self.background_loads
+        self.background_loads = False
+        try:
+            self.onecmd(line)
+        finally:
+            self.background_loads = background_loads
+
+    def do_profile(self, rest):
+        """
+        profile [-n N] [-s sortkey] [-o file.pstats] command [args]
+        Run the given command under cProfile and show the N (default
+        20) functions that took the longest, sorted by cumulative time
+        or any other pstats sort key.  The statistics are also saved to
+        the given file for later analysis with pstats.
+        """
+        try:
+            options, line = self.__parse_meta_options(
+                rest, {'-n': 20, '-s': 'cumulative', '-o': None})
+            if not line:
+                self.error("No command given.")
+                return
+            profiler = cProfile.Profile()
+            profiler.runcall(self.__run_in_foreground, line)
+            stats = pstats.Stats(profiler, stream=sys.stdout)
+            stats.strip_dirs().sort_stats(options['-s'])
+            stats.print_stats(options['-n'])
+            if options['-o']:
+                profiler.dump_stats(options['-o'])
+                print "Saved profile to %s." % options['-o']
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_memtrace(self, rest):
+        """
+        memtrace [-n N] command [args]
+        Run the given command and show how much memory it took, at its
+        peak and afterwards, and the N (default 10) places that
+        allocated the most of what is left.  Without the tracemalloc
+        module, those are the types of objects whose number grew the
+        most, and the memory shown is the resident size before and
+        after the command, next to the peak of the whole process so
+        far, which may have been reached by an earlier command.
+        """
+        try:
+            options, line = self.__parse_meta_options(rest, {'-n': 10})
+            if not line:
+                self.error("No command given.")
+                return
+            if tracemalloc:
+                self.__memtrace_tracemalloc(line, options['-n'])
+            else:
+                self.__memtrace_objects(line, options['-n'])
+        except Exception, e:
+            self.error("Error:", e)
+
+    def __memtrace_tracemalloc(self, line, count):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            self.__run_in_foreground(line)
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        print 'Peak traced memory: %0.1f MB, now %0.1f MB.' % (
+            peak / 1048576.0, current / 1048576.0)
+        print 'Top allocation sites:'
+        for x in after.compare_to(before, 'lineno')[:count]:
+            print x
+
+    def __memtrace_objects(self, line, count):
+        def count_objects():
+            gc.collect()
+            counts = collections.defaultdict(int)
+            for x in gc.get_objects():
+                counts[type(x).__name__] += 1
+            return counts
+        def rss():
+            # Current resident size, Linux only.
+            try:
+                f = open('/proc/self/statm')
+                try:
+                    pages = int(f.read().split()[1])
+                finally:
+                    f.close()
+            except (IOError, ValueError, IndexError):
+                return None
+            return pages * resource.getpagesize() / 1048576.0
+        before = count_objects()
+        rss_before = rss()
+        self.__run_in_foreground(line)
+        rss_after = rss()
+        if rss_before is not None and rss_after is not None:
+            print 'Resident size: %0.1f MB (%+0.1f MB).' % (
+                rss_after, rss_after - rss_before)
+        # In kilobytes on Linux.
+        print 'Process peak resident size: %0.1f MB.' % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+        after = count_objects()
+        growth = [(after[x] - before.get(x, 0), x) for x in after]
+        growth.sort(reverse=True)
+        print 'Object types that grew the most:'
+        for n, name in growth[:count]:
+            if n > 0:
+                print '%10d %s' % (n, name)
+
     def do_p(self, rest):
         """
         Pause/play toggle.
@@ -496,41 +3859,30 @@ class PlayerShell(cmd.Cmd):
         """
         Move to the first track of the next album in the playlist.
         """
-        curr = self.player.current_track - 1;
-        albums = [x.album for x in self.player.playlist]
-        orig_album = albums[curr]
-        for x in range(curr + 1, len(albums)):
-            if albums[x] != orig_album:
-                self.player.current_track = x + 1
-                break
-        # in case orig_album is the last albums
-        if x == len(albums) - 1:
-            self.current_track = len(albums)
+        playlist = self.player.playlist
+        album = playlist.album_index(self.player.current_track - 1)
+        if album + 1 < playlist.album_count:
+            self.player.current_track = playlist.album_start(album + 1) + 1
 
     def do_prev_album(self, rest):
         """
         Move to the first track of the previous album in the playlist.
         """
-        curr = self.player.current_track - 1;
-        albums = [x.album for x in self.player.playlist[:curr+1]]
-        orig_album = albums[curr]
-        target_album = None
-        for x in range(curr - 1, -1, -1):
-            if not target_album:
-                if albums[x] != orig_album:
-                    target_album = albums[x]
-            elif albums[x] != target_album:
-                self.player.current_track = x + 2
-                break
-        # in case orig_album is the first album
-        if x == 0:
-            self.current_track = 1
+        playlist = self.player.playlist
+        album = playlist.album_index(self.player.current_track - 1)
+        if album > 0:
+            self.player.current_track = playlist.album_start(album - 1) + 1
+        elif playlist:
+            self.player.current_track = 1
 
     def do_loaddaap(self, rest):
         """
         loaddaap server[:port] [password]
         Load track collection from the given DAAP server.
         """
+        self.__loaddaap(rest)
+
+    def __loaddaap(self, rest, dbfile=None):
         server = "localhost"
         port = 3689
         password = None
@@ -544,21 +3896,191 @@ class PlayerShell(cmd.Cmd):
             password = fields[1]
         print "Connecting to %s:%d" % (server,port)
         try:
-            self.collection = DaapCollection(server, port, password)
-            print "Loaded %d tracks." % len(self.collection.tracks)
+            self.collection = DaapCollection(server, port, password,
+                                             background=self.background_loads,
+                                             dbfile=dbfile)
+            self.__print_loading()
         except Exception, e:
-            print "Error:", e
+            self.error("Error:", e)
 
     def do_loaddir(self, rest):
         """
         loaddaap basedir
         Load track collection from the given directory.
         """
+        self.__loaddir(rest)
+
+    def __loaddir(self, rest, dbfile=None):
         try:
-            self.collection = DirectoryCollection(rest)
-            print "Loaded %d tracks." % len(self.collection.tracks)
+            self.collection = DirectoryCollection(
+                rest, background=self.background_loads, dbfile=dbfile)
+            self.__print_loading()
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_loadall(self, rest):
+        """
+        loadall [password@]server[:port] ... dir:basedir ...
+        Load tracks from several DAAP servers and directories at once
+        and merge them into one collection.
+        """
+        sources = []
+        try:
+            for x in rest.split():
+                if x.startswith('dir:'):
+                    sources.append(('dir', x[4:]))
+                    continue
+                password = None
+                port = 3689
+                if '@' in x:
+                    password, x = x.rsplit('@', 1)
+                if ':' in x:
+                    x, port = x.split(':')
+                    port = int(port)
+                sources.append(('daap', x, port, password))
+            if not sources:
+                self.error("No sources given.")
+                return
+            self.collection = FederatedCollection(
+                sources, background=self.background_loads)
+            self.__print_loading()
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_loaddb(self, rest):
+        """
+        loaddb /path/to/tracks.db [daap server[:port] [password] | dir basedir]
+        Open a track collection stored in the given sqlite database, or
+        load one into it from a DAAP server or directory.  The tracks
+        are kept on disk instead of in memory, so this works for
+        collections of any size.
+        """
+        fields = rest.split(None, 2)
+        if not fields:
+            self.error("No database given.")
+        elif len(fields) == 1:
+            try:
+                self.collection = SqliteCollection(fields[0])
+                print "Loaded %d tracks." % len(self.collection.tracks)
+            except Exception, e:
+                self.error("Error:", e)
+        elif fields[1] == 'daap':
+            self.__loaddaap(' '.join(fields[2:]), dbfile=fields[0])
+        elif fields[1] == 'dir' and len(fields) > 2:
+            self.__loaddir(fields[2], dbfile=fields[0])
+        else:
+            self.error("Unknown source: %s" % ' '.join(fields[1:]))
+
+    def __print_loading(self):
+        if self.collection.loading:
+            print "Loading tracks in the background, see 'progress'."
+        else:
+            print self.collection.progress
+
+    def do_progress(self, rest):
+        """
+        Show how much of the collection has been loaded so far.
+        """
+        if not self.collection:
+            print "No collection loaded."
+        else:
+            print self.collection.progress
+
+    def do_watch(self, rest):
+        """
+        watch [on|off]
+        Keep the current directory collection up to date as files are
+        added, changed, moved or deleted (Linux only).
+        """
+        if not isinstance(self.collection, DirectoryCollection):
+            self.error("Only directory collections can be watched.")
+            return
+        if self.collection.loading:
+            self.error("Wait for the collection to finish loading first.")
+            return
+        try:
+            if rest.strip() == 'off':
+                self.collection.unwatch()
+            else:
+                self.collection.watch()
+            print "Watching %s: %s" % (self.collection.basedir,
+                                       self.collection.watcher is not None)
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_cache(self, rest):
+        """
+        cache [size_in_mb|off]
+        Show the state of the local track cache, change its size or
+        turn it off.
+        """
+        cache = self.player.cache
+        try:
+            if rest.strip() == 'off':
+                self.player.cache = None
+            elif rest.strip():
+                if not cache:
+                    cache = self.player.cache = TrackCache(
+                        metrics=self.player.metrics)
+                cache.max_bytes = int(float(rest) * 1048576)
+            if self.player.cache:
+                print self.player.cache
+            else:
+                print "Track cache is off."
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_querycache(self, rest):
+        """
+        querycache [clear]
+        Show how often searches of the collection and the playlist
+        were answered from the search result cache, or clear it.
+        """
+        for name, searched in [('Collection', self.collection),
+                               ('Playlist', self.player.playlist)]:
+            cache = getattr(searched, 'query_cache', None)
+            if cache is None:
+                print '%s: no searches yet.' % name
+                continue
+            if rest.strip() == 'clear':
+                cache.clear()
+            print '%s: %s' % (name, cache)
+
+    def do_metrics(self, rest):
+        """
+        metrics [prometheus | write file [seconds] | serve [[host:]port] |
+                 reset]
+        Show how playback has gone per server: track start times, gaps
+        between tracks, buffering stalls, read rates and errors.
+        prometheus prints them in the Prometheus text format, write
+        saves that to a file (every so many seconds if given) and serve
+        makes it available over HTTP at /metrics (port 9466 on
+        localhost by default).
+        """
+        metrics = self.player.metrics
+        args = rest.split()
+        try:
+            if not args:
+                print_to_pager(metrics)
+            elif args[0] == 'prometheus':
+                sys.stdout.write(metrics.prometheus())
+            elif args[0] == 'write' and len(args) in (2, 3):
+                interval = float(args[2]) if len(args) == 3 else None
+                metrics.write(args[1], interval)
+                print "Metrics written to %s" % args[1]
+            elif args[0] == 'serve' and len(args) <= 2:
+                host, port = '127.0.0.1', '9466'
+                if len(args) == 2:
+                    host, sep, port = args[1].rpartition(':')
+                    host = host or '127.0.0.1'
+                metrics.serve(int(port), host)
+                print "Serving metrics on http://%s:%s/metrics" % (host, port)
+            elif args == ['reset']:
+                metrics.reset()
+            else:
+                self.error("Error: unknown metrics command %r" % rest)
         except Exception, e:
-            print "Error:", e
+            self.error("Error:", e)
 
     def do_loadpkl(self, rest):
         """
@@ -570,34 +4092,52 @@ class PlayerShell(cmd.Cmd):
             self.collection = pickle.load(f)
             f.close()
             print "Loaded %d tracks." % len(self.collection.tracks)
-            print self.collection.tracks
         except Exception, e:
-            print "Error:", e
+            self.error("Error:", e)
+
+    def do_loadcollection(self, rest):
+        """
+        loadcollection /path/to/tracks.snapshot
+        Open a track collection previously saved with savecollection.
+        """
+        try:
+            self.collection = SnapshotCollection(rest)
+            print "Loaded %d tracks." % len(self.collection.tracks)
+        except Exception, e:
+            self.error("Error:", e)
 
     def do_savecollection(self, rest):
         """
-        savecollection /path/to/tracks.pkl
-        Save collection to the given pickle file.
+        savecollection /path/to/tracks.snapshot
+        Save collection to the given snapshot file.
         """
+        if not self.collection:
+            self.error("No collection loaded, run load first.")
+            return
         try:
-            f = open(rest, 'w')
-            pickle.dump(self.collection, f, pickle.HIGHEST_PROTOCOL)
-            f.close()
+            write_snapshot(self.collection.tracks, rest)
         except Exception, e:
-            print "Error:", e
+            self.error("Error:", e)
 
     def do_search(self, rest, print_tracks=True, collection=None):
         """
-        search pattern [in field1 or field2 or ... [AND [pattern] [in field] ...]]
+        search pattern [in field1 or field2 or ... [AND [pattern] [in field] ...]] [limit N] [offset N]
         Search collection for tracks whose given pattern matches any of
-        the listed fields (defaults to "artist album name").
+        the listed fields (defaults to "artist album name").  Only N
+        results are shown with limit, starting from the given offset.
         """
         if collection is None:
             collection = self.collection
         
         if not self.collection:
-            print "No collection loaded, run load first."
+            self.error("No collection loaded, run load first.")
             return
+        paging = {'limit': None, 'offset': 0}
+        match = re.search(r'\s*\b(limit|offset)\s+(\d+)\s*$', rest)
+        while match:
+            paging[match.group(1)] = int(match.group(2))
+            rest = rest[:match.start()]
+            match = re.search(r'\s*\b(limit|offset)\s+(\d+)\s*$', rest)
         pattern = '.'
         default_attrs = ('artist', 'album', 'name')
         try:
@@ -612,6 +4152,8 @@ class PlayerShell(cmd.Cmd):
                     attrs = default_attrs
                     if len(fields) > 1:
                         attrs = [x.strip() for x in fields[1].split(' or ')]
+                    # Each term is searched for on its own, so terms
+                    # shared with earlier queries come from the cache.
                     curr_tracks = collection.search(pattern, fields=attrs)
                     if not tracks:
                         tracks = curr_tracks
@@ -625,11 +4167,112 @@ class PlayerShell(cmd.Cmd):
         except TypeError:
             print 'TypeError???'
             tracks = None
+        if tracks and (paging['offset'] or paging['limit'] is not None):
+            start = paging['offset']
+            stop = None
+            if paging['limit'] is not None:
+                stop = start + paging['limit']
+            if print_tracks:
+                print '%d matching tracks.' % len(tracks)
+                print_to_pager(tracks.lines(start, stop))
+                return
+            tracks = tracks[start:stop]
         if print_tracks and tracks:
             print_to_pager(tracks)
         else:
             return tracks
 
+    def do_stats(self, rest):
+        """
+        stats [field] [by tracks|time|size] [top N]
+        Without a field, summarize the collection.  Otherwise show the
+        number of tracks, hours and gigabytes for each genre, artist,
+        album or format, or for each year, track, disc, bitrate, time
+        (in minutes) or size (in MB), ordered by the given column.
+        Needs NumPy.
+        """
+        if not self.collection:
+            self.error("No collection loaded, run load first.")
+            return
+        args = rest.split()
+        options = {'by': None, 'top': None}
+        while len(args) > 1 and args[-2] in options:
+            options[args[-2]] = args[-1]
+            del args[-2:]
+        if options['by'] not in (None, 'tracks', 'time', 'size'):
+            print 'Error: can only order by tracks, time or size.'
+            return
+        try:
+            collection = self.collection
+            stats = self.__stats
+            if (stats is None or stats[0] is not collection
+                or stats[1] != collection.generation):
+                # Only read the tracks again once they have changed.
+                stats = (collection, collection.generation,
+                         CollectionStats(collection.tracks))
+                self.__stats = stats
+            stats = stats[2]
+            if not args:
+                print ('%d tracks, %0.1f hours, %0.1f GB, %d artists, '
+                       '%d albums, %d genres' % (
+                           stats.count, stats.total('time') / 3600,
+                           stats.total('size') / 1073741824.0,
+                           stats.distinct('artist'),
+                           stats.distinct('album'),
+                           stats.distinct('genre')))
+                return
+            limit = options['top'] and int(options['top'])
+            groups = stats.group(args[0], options['by'], limit)
+        except AttributeError, name:
+            print 'Error: no such field: "%s"' % name
+            return
+        except Exception, e:
+            self.error("Error:", e)
+            return
+        lines = ['%8s %8s %8s  %s' % ('tracks', 'hours', 'GB', args[0])]
+        for label, tracks, seconds, nbytes in groups:
+            if label is None:
+                label = '(none)'
+            lines.append((u'%8d %8.1f %8.2f  %s' % (
+                tracks, seconds / 3600, nbytes / 1073741824.0,
+                label)).encode('utf-8'))
+        print_to_pager(lines)
+
+    def do_count(self, rest):
+        """
+        count pattern [in field1 or field2 or ... [AND [pattern] [in field] ...]]
+        Print the number of tracks that search would find.
+        """
+        tracks = self.do_search(rest, print_tracks=False)
+        if tracks is not None:
+            print '%d matching tracks.' % len(tracks)
+
+    search_fields = ['artist', 'album', 'name', 'genre', 'year', 'format',
+                     'track', 'disc']
+
+    def complete_search(self, text, line, begidx, endidx):
+        """ Complete artist, album and genre names, or field names
+        after "in". """
+        if not self.collection:
+            return []
+        # Only look at the current search term.
+        args = line[:endidx].split(None, 1)[1:] or ['']
+        term = re.compile('and', re.IGNORECASE).split(args[0])[-1]
+        if ' in ' in term:
+            field = term.split(' in ')[-1].split(' or ')[-1].strip()
+            return [x for x in self.search_fields if x.startswith(field)]
+        # Values can contain spaces, but readline only replaces the
+        # last word.  readline works in utf-8 bytes, the collection in
+        # unicode.
+        prefix = term.lstrip().decode('utf-8', 'replace')
+        if not prefix:
+            return []
+        offset = len(prefix) - len(text.decode('utf-8', 'replace'))
+        return [x[offset:].encode('utf-8')
+                for x in self.collection.complete(prefix)]
+
+    complete_add = complete_search
+
     def do_add(self, rest):
         """
         add pattern [in field1 or field2 or ... [AND [pattern] [in field] ...]]
@@ -667,6 +4310,49 @@ class PlayerShell(cmd.Cmd):
         else:
             print "Couldn't find any matching tracks."
 
+    def do_playlists(self, rest):
+        """
+        List the playlists on the DAAP server.
+        """
+        if not isinstance(self.collection, DaapCollection):
+            print "Only DAAP collections have playlists."
+            return
+        try:
+            for n, x in enumerate(self.collection.playlists()):
+                print '%d: %s (%d tracks)' % (n + 1, x.name, x.count or 0)
+        except Exception, e:
+            self.error("Error:", e)
+
+    def do_addplaylist(self, rest):
+        """
+        addplaylist number|name
+        Add the tracks of the given playlist on the DAAP server (see
+        playlists) to the current playlist.
+        """
+        if not isinstance(self.collection, DaapCollection):
+            print "Only DAAP collections have playlists."
+            return
+        try:
+            playlists = self.collection.playlists()
+            rest = rest.strip()
+            if rest.isdigit() and 0 < int(rest) <= len(playlists):
+                matches = [playlists[int(rest) - 1]]
+            else:
+                name = rest.lower()
+                matches = [x for x in playlists
+                           if (x.name or '').lower() == name]
+                if not matches:
+                    matches = [x for x in playlists
+                               if (x.name or '').lower().startswith(name)]
+            if len(matches) != 1:
+                print 'Found %d playlists named "%s".' % (len(matches), rest)
+                return
+            tracks = self.collection.playlist_tracks(matches[0])
+            self.player.playlist.extend(tracks)
+            print 'Added %d items.' % len(tracks)
+        except Exception, e:
+            self.error("Error:", e)
+
     def do_clear(self, rest):
         """
         Clear the current playlist.
@@ -675,10 +4361,157 @@ class PlayerShell(cmd.Cmd):
         self.player.playlist.clear()
 
 
+class _ClientOutput(object):
+    """ Stands in for sys.stdout while running a command for a client
+    of PlayerDaemon, sending everything printed straight to it. """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.connection.sendall(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        # Never page output for clients.
+        return False
+
+
+class _DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        shell = self.server.shell
+        failed = 0
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            stdout = sys.stdout
+            # cmd.Cmd writes some messages to its own stdout.
+            sys.stdout = shell.stdout = _ClientOutput(self.connection)
+            try:
+                shell.onecmd(shell.precmd(line))
+                failed += shell.failed
+            except SystemExit:
+                # exit stops the daemon.
+                self.server.stopping = True
+                return
+            except socket.error:
+                # The client went away.
+                return
+            except Exception, e:
+                print "Error:", e
+                failed += 1
+            finally:
+                sys.stdout = shell.stdout = stdout
+        # End the output with the number of commands that failed, see
+        # send_commands.
+        self.connection.sendall('\0%d\n' % failed)
+
+
+class PlayerDaemon(SocketServer.UnixStreamServer):
+    """
+    Keeps a PlayerShell, with its collection, indexes and GStreamer
+    pipeline, running in the background and runs the commands sent to
+    it over a Unix domain socket (see send_commands), one at a time.
+    Their output is sent back as it is printed.
+    """
+    stopping = False
+
+    def __init__(self, shell, path='~/.daap_player_socket'):
+        self.shell = shell
+        self.path = os.path.expanduser(path)
+        if os.path.exists(self.path):
+            # Only take over the socket if nobody is listening on it.
+            try:
+                send_commands([], self.path)
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise ValueError('A daemon is already running on %s'
+                                 % self.path)
+        # Only we may connect, from the moment the socket exists.
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, self.path,
+                                                   _DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        """ Run commands until one of them is exit. """
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.remove(self.path)
+
+
+def send_commands(commands, path='~/.daap_player_socket', out=sys.stdout):
+    """ Run the given shell commands in the PlayerDaemon listening on
+    path, writing their output to out as it arrives.  Return the number
+    of commands that failed. """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # The output ends with a NUL and the number of failed commands.
+    status = None
+    try:
+        client.connect(os.path.expanduser(path))
+        client.sendall(''.join(['%s\n' % x for x in commands]))
+        client.shutdown(socket.SHUT_WR)
+        data = client.recv(65536)
+        while data:
+            if status is None:
+                text, sep, rest = data.partition('\0')
+                out.write(text)
+                if sep:
+                    status = rest
+            else:
+                status += data
+            data = client.recv(65536)
+    finally:
+        client.close()
+    if not status or not status.strip():
+        # Stopped by exit
+        return 0
+    return int(status)
+
+
 if __name__ == "__main__":
     #import logging
     #logging.basicConfig(level=logging.DEBUG,
     #        format='%(asctime)s %(levelname)s %(message)s')
-    shell = PlayerShell()
-    shell.cmdloop()
+    parser = optparse.OptionParser(
+        usage='%prog [-d | -c command [-c command ...]] [-s socket] [-p]')
+    parser.add_option('-d', '--daemon', action='store_true',
+                      help='keep running in the background, taking commands '
+                      'from the socket')
+    parser.add_option('-c', '--command', action='append', default=[],
+                      help='run a command in the daemon and print its output')
+    parser.add_option('-s', '--socket', default='~/.daap_player_socket',
+                      help='socket of the daemon [%default]')
+    parser.add_option('-p', '--prefork', action='store_true',
+                      help='start the processes decoding large DAAP '
+                      'libraries now, before any threads are running')
+    options, args = parser.parse_args()
+    if (options.prefork and not options.command and
+        multiprocessing.cpu_count() > 1):
+        daap.startPool()
+    if options.command:
+        try:
+            failed = send_commands(options.command, options.socket)
+        except socket.error, e:
+            print "Error: can't reach the daemon:", e
+            sys.exit(1)
+        if failed:
+            sys.exit(1)
+    elif options.daemon:
+        shell = PlayerShell()
+        shell.preloop()
+        PlayerDaemon(shell, options.socket).serve()
+    else:
+        shell = PlayerShell()
+        shell.cmdloop()
 